@@ -65,6 +65,40 @@ if __name__ == '__main__':
             else:
                 print("roundrobininsert function fail!")
 
+            testHelper.deleteAllPublicTables(conn)
+            MyAssignment.loadratings(RATINGS_TABLE, INPUT_FILE_PATH, conn)
+
+            [result, e] = testHelper.testhashpartition(MyAssignment, RATINGS_TABLE, 5, conn, ACTUAL_ROWS_IN_INPUT_FILE)
+            if result :
+                print("hashpartition function pass!")
+            else:
+                print("hashpartition function fail!")
+
+            MyAssignment.rangepartition(RATINGS_TABLE, 5, conn)
+            MyAssignment.roundrobinpartition(RATINGS_TABLE, 5, conn)
+            for prefix in [RANGE_TABLE_PREFIX, RROBIN_TABLE_PREFIX, testHelper.HASH_TABLE_PREFIX]:
+                [result, e] = testHelper.testrepartition(MyAssignment, RATINGS_TABLE, 3, conn, prefix, ACTUAL_ROWS_IN_INPUT_FILE)
+                if result :
+                    print("repartition function pass for " + prefix + "!")
+                else:
+                    print("repartition function fail for " + prefix + "!")
+
+            MyAssignment.rangepartition(RATINGS_TABLE, 5, conn)
+            [result, e] = testHelper.testroutingtrigger(MyAssignment, RATINGS_TABLE, RANGE_TABLE_PREFIX, 5, 100, 3, 3, conn, '2')
+            if result :
+                print("installroutingtrigger function pass!")
+            else:
+                print("installroutingtrigger function fail!")
+
+            MyAssignment.roundrobinpartition(RATINGS_TABLE, 5, conn)
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM {0}0".format(RROBIN_TABLE_PREFIX))
+            [result, e] = testHelper.testrebalanceroundrobin(MyAssignment, 5, conn)
+            if result :
+                print("rebalanceroundrobin function pass!")
+            else:
+                print("rebalanceroundrobin function fail!")
+
             choice = input('Press enter to Delete all tables? ')
             if choice == '':
                 testHelper.deleteAllPublicTables(conn)
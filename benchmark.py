@@ -0,0 +1,229 @@
+"""
+Non-interactive benchmark of the loading, partitioning and insert functions.
+
+Generates MovieLens-style 'userid::movieid::rating::timestamp' files of the requested sizes and
+rating skew, runs every function against a local PostgreSQL database and writes one record per
+measured step as JSON or CSV, so runs of different revisions can be compared. Each record also
+carries the time spent in every phase of the step, as reported by the instrumentation module.
+
+Example:
+    python benchmark.py --sizes 10000 1000000 10000000 --output results.json
+"""
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import random
+import subprocess
+import time
+
+import function
+import testHelper
+from instrumentation import MemorySink, set_sink
+
+RATINGS_TABLE = 'ratings'
+# Generated files are kept here between runs unless --datadir says otherwise
+DEFAULT_DATADIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'ratings_bench')
+RATING_VALUES = [0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0]
+# Approximate share of each rating value in the MovieLens datasets
+MOVIELENS_WEIGHTS = [0.011, 0.032, 0.016, 0.074, 0.044, 0.199, 0.105, 0.266, 0.085, 0.168]
+
+
+def rating_weights(skew):
+    """
+    Weights of RATING_VALUES: 0 is uniform, 1 is the MovieLens distribution, values in between mix the two.
+    """
+    uniform = 1.0 / len(RATING_VALUES)
+    return [(1 - skew) * uniform + skew * weight for weight in MOVIELENS_WEIGHTS]
+
+
+def generateratings(filepath, rows, skew=1.0, seed=0, users=None, movies=None):
+    """
+    Write `rows` ratings in the '::' format of the MovieLens dumps.
+    """
+    rng = random.Random(seed)
+    users = users or max(1, rows // 150)
+    movies = movies or max(1, min(rows // 10, 60000))
+    weights = rating_weights(skew)
+    chunk = 100000
+    with open(filepath, 'w') as file:
+        written = 0
+        while written < rows:
+            n = min(chunk, rows - written)
+            ratings = rng.choices(RATING_VALUES, weights, k=n)
+            file.write(''.join(
+                f"{rng.randint(1, users)}::{rng.randint(1, movies)}::{rating:g}::{rng.randint(789652009, 1700000000)}\n"
+                for rating in ratings))
+            written += n
+
+
+def _revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _measure(results, context, step, variant, rows, func, *args, **kwargs):
+    # Collect the phases of this step only, and keep any output of the functions out of the report
+    sink = set_sink(MemorySink())
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func(*args, **kwargs)
+            seconds = time.perf_counter() - start
+    finally:
+        set_sink(None)
+    phases = {name: dict(count=stats['count'], seconds=round(stats['seconds'], 6), rows=stats['rows'])
+              for name, stats in sink.summary().items()}
+    record = dict(context, step=step, variant=variant, rows=rows, seconds=round(seconds, 6),
+                  rows_per_sec=round(rows / seconds, 1) if seconds > 0 else None, phases=phases)
+    results.append(record)
+    print(f"{record['size']:>10} {step:<22} {variant:<12} {seconds:10.4f}s")
+    return record
+
+
+def _insert_rows(count, seed):
+    rng = random.Random(seed)
+    return [(rng.randint(1, 100000), rng.randint(1, 60000), rng.choice(RATING_VALUES)) for _ in range(count)]
+
+
+def _single_inserts(insert, rows, conn):
+    for userid, movieid, rating in rows:
+        insert(RATINGS_TABLE, userid, movieid, rating, conn)
+
+
+def _range_query(conn):
+    cur = conn.cursor()
+    cur.execute(f"SELECT COUNT(*) FROM {RATINGS_TABLE} WHERE rating > 4 AND rating <= 5;")
+    cur.fetchone()
+    cur.close()
+
+
+def runbenchmarks(conn, filepath, size, partitions, inserts, workers, context):
+    results = []
+    context = dict(context, size=size, partitions=partitions)
+    rows = _insert_rows(inserts, seed=size)
+
+    # Loading
+    _measure(results, context, 'loadratings', 'staging', size, function.loadratings,
+             RATINGS_TABLE, filepath, conn, method='staging')
+    _measure(results, context, 'loadratings', 'parallel', size, function.loadratings,
+             RATINGS_TABLE, filepath, conn, workers=workers)
+    _measure(results, context, 'loadratings', 'stream', size, function.loadratings,
+             RATINGS_TABLE, filepath, conn)
+
+    # Range partitioning on the copy-based layout
+    _measure(results, context, 'rangepartition', 'multi_pass', size, function.rangepartition,
+             RATINGS_TABLE, partitions, conn, method='multi_pass')
+    _measure(results, context, 'rangepartition', 'single_pass', size, function.rangepartition,
+             RATINGS_TABLE, partitions, conn)
+    _measure(results, context, 'rangequery', 'copy', size, _range_query, conn)
+    _measure(results, context, 'rangeinsert', 'copy', inserts, _single_inserts, function.rangeinsert, rows, conn)
+    _measure(results, context, 'rangeinsertbatch', 'copy', inserts, function.rangeinsertbatch,
+             RATINGS_TABLE, rows, conn)
+    # The same inserts routed on the server by a trigger
+    function.installroutingtrigger('range_part', conn)
+    _measure(results, context, 'rangeinsert', 'trigger', inserts, _single_inserts, function.rangeinsert, rows, conn)
+    _measure(results, context, 'rangeinsertbatch', 'trigger', inserts, function.rangeinsertbatch,
+             RATINGS_TABLE, rows, conn)
+    function.droproutingtrigger('range_part', conn)
+
+    # Round robin partitioning
+    _measure(results, context, 'roundrobinpartition', 'multi_pass', size, function.roundrobinpartition,
+             RATINGS_TABLE, partitions, conn, method='multi_pass')
+    _measure(results, context, 'roundrobinpartition', 'single_pass', size, function.roundrobinpartition,
+             RATINGS_TABLE, partitions, conn)
+    _measure(results, context, 'roundrobininsert', 'copy', inserts, _single_inserts, function.roundrobininsert,
+             rows, conn)
+    _measure(results, context, 'roundrobininsertbatch', 'copy', inserts, function.roundrobininsertbatch,
+             RATINGS_TABLE, rows, conn)
+    function.installroutingtrigger('rrobin_part', conn)
+    _measure(results, context, 'roundrobininsert', 'trigger', inserts, _single_inserts, function.roundrobininsert,
+             rows, conn)
+    _measure(results, context, 'roundrobininsertbatch', 'trigger', inserts, function.roundrobininsertbatch,
+             RATINGS_TABLE, rows, conn)
+    function.droproutingtrigger('rrobin_part', conn)
+
+    # Range partitioning on the native declarative layout
+    _measure(results, context, 'rangepartition', 'native', size, function.rangepartition,
+             RATINGS_TABLE, partitions, conn, backend='native')
+    _measure(results, context, 'rangequery', 'native', size, _range_query, conn)
+    _measure(results, context, 'rangeinsert', 'native', inserts, _single_inserts, function.rangeinsert, rows, conn)
+    _measure(results, context, 'rangeinsertbatch', 'native', inserts, function.rangeinsertbatch,
+             RATINGS_TABLE, rows, conn)
+
+    # Loading the file straight into the partitions, with and without the ratings table
+    _measure(results, context, 'loadandpartition', 'range', size, function.loadandpartition,
+             RATINGS_TABLE, filepath, 'range', partitions, conn)
+    _measure(results, context, 'loadandpartition', 'range_partitions_only', size, function.loadandpartition,
+             RATINGS_TABLE, filepath, 'range', partitions, conn, materialize=False)
+    _measure(results, context, 'loadandpartition', 'roundrobin', size, function.loadandpartition,
+             RATINGS_TABLE, filepath, 'roundrobin', partitions, conn)
+    return results
+
+
+def writeresults(results, output, fmt):
+    if fmt == 'csv':
+        fields = list(results[0]) if results else []
+        with open(output, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=fields)
+            writer.writeheader()
+            # The per-phase breakdown is nested, keep it as a JSON string in its column
+            writer.writerows(dict(result, phases=json.dumps(result['phases'])) for result in results)
+    else:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 1000000, 10000000])
+    parser.add_argument('--partitions', type=int, default=5)
+    parser.add_argument('--inserts', type=int, default=1000, help='rows inserted by each insert benchmark')
+    parser.add_argument('--workers', type=int, default=4, help='connections used by the parallel loader')
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='0 for uniform ratings, 1 for the MovieLens rating distribution')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--datadir', default=DEFAULT_DATADIR,
+                        help='where generated files are kept and reused between runs (default: %(default)s)')
+    parser.add_argument('--dbname', default='db_benchmark')
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='root')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--format', choices=('json', 'csv'), default=None,
+                        help='defaults to the extension of --output')
+    args = parser.parse_args()
+
+    fmt = args.format or ('csv' if args.output.endswith('.csv') else 'json')
+    datadir = args.datadir
+    os.makedirs(datadir, exist_ok=True)
+    context = dict(revision=_revision(), skew=args.skew, seed=args.seed,
+                   started=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        function.create_db(args.dbname, args.user, args.password)
+    conn = function.getopenconnection(args.user, args.password, args.dbname)
+    results = []
+    try:
+        for size in args.sizes:
+            filepath = os.path.join(datadir, f"ratings_{size}_{args.skew:g}_{args.seed}.dat")
+            if not os.path.exists(filepath):
+                generateratings(filepath, size, args.skew, args.seed)
+            testHelper.deleteAllPublicTables(conn)
+            conn.commit()
+            results.extend(runbenchmarks(conn, filepath, size, args.partitions, args.inserts, args.workers, context))
+        testHelper.deleteAllPublicTables(conn)
+        conn.commit()
+    finally:
+        conn.close()
+        function.closepools()
+        writeresults(results, args.output, fmt)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,259 +1,2387 @@
+import collections
+import contextlib
+import mmap
+import os
 import psycopg2
+import psycopg2.extras
+import queue
+import struct
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+import routing
+from instrumentation import phase, record, timed
+
+# Per ratings table round robin routing state: number of rows ever inserted and number of partitions
+RROBIN_META_TABLE = 'rrobin_meta'
+# Layout of every partitioned set of tables, keyed by the partition table prefix
+PARTITION_REGISTRY_TABLE = 'partition_registry'
+# Per-partition row count and min/max of every column, used to skip partitions in lookups
+PARTITION_ZONEMAP_TABLE = 'partition_zonemap'
+# Node (libpq connection string) holding each partition that does not live in the coordinator database
+PARTITION_PLACEMENT_TABLE = 'partition_placement'
+# Rows shipped to a node are buffered in memory up to this size per partition, then on disk
+SPOOL_MEMORY_BYTES = 64 * 1024 * 1024
+# Chunks of parsed lines queued per table by loadandpartition, the file reader waits for a table this far behind
+LOAD_QUEUE_DEPTH = 8
+ZONEMAP_COLUMNS = ('userid', 'movieid', 'rating')
+
+# In-process copy of the registry, keyed by (connection dsn, prefix)
+_partition_cache = {}
+
+# Connection pools shared by every helper that needs extra connections, keyed by connection parameters
+POOL_MAX_CONNECTIONS = 16
+# Idle pooled connections older than this are checked with a round trip before they are reused
+POOL_PROBE_IDLE_SECONDS = 30.0
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Databases already known to exist, so create_db only checks each one once per process
+_known_databases = set()
+
+# 'logged' builds crash-safe tables, 'unlogged' builds UNLOGGED tables without waiting for the WAL
+# flush at commit and leaves them unlogged, 'deferred' does the same and turns them LOGGED at the end
+DURABILITY_MODES = ('logged', 'unlogged', 'deferred')
+
+# 'inplace' empties and refills the live partitions, 'shadow' fills SHADOW_SUFFIX copies next to
+# them and only swaps the names right before the commit
+BUILD_MODES = ('inplace', 'shadow')
+SHADOW_SUFFIX = '__new'
+
+# Indexes built on every partition by the indexes option, as (name suffix, definition)
+PARTITION_INDEXES = (('userid_idx', '(userid)'), ('movieid_idx', '(movieid)'), ('rating_brin', 'USING brin (rating)'))
 
 
 def getopenconnection(user='postgres', password='root', dbname='dds_assign1'):
-    return psycopg2.connect("dbname='" + dbname + "' user='" + user + "' host='localhost' password='" + password + "'")
+    return psycopg2.connect(dbname=dbname, user=user, host='localhost', password=password)
 
 
-def create_db(dbname):
-    start_time = time.time()
+class _ConnectionPool:
+    """
+    Connections to one database: every returned connection is kept idle for the next borrower,
+    and at most POOL_MAX_CONNECTIONS are borrowed at once (further borrowers wait for a slot).
+    """
+
+    def __init__(self, connection_params):
+        self.connection_params = connection_params
+        self.slots = threading.BoundedSemaphore(POOL_MAX_CONNECTIONS)
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+
+    def getconn(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                con, idle_since = self._idle.pop()
+            # Only connections idle for a while are probed, a recently used one is taken as it is
+            if _is_healthy(con) and (time.monotonic() - idle_since < POOL_PROBE_IDLE_SECONDS or _is_alive(con)):
+                return con
+            con.close()
+        return psycopg2.connect(**self.connection_params)
+
+    def putconn(self, con, close=False):
+        if close:
+            con.close()
+            return
+        with self._lock:
+            self._idle.append((con, time.monotonic()))
+
+    def closeall(self):
+        with self._lock:
+            while self._idle:
+                self._idle.pop()[0].close()
+
+
+def _get_pool(connection_params):
+    key = tuple(sorted(connection_params.items()))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = _ConnectionPool(connection_params)
+    return pool
+
+
+def _is_healthy(con):
+    return not con.closed and con.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+
+
+def _is_alive(con):
+    """
+    Whether the server side of an idle pooled connection still answers. A backend that was
+    terminated or a server that restarted only shows once the connection is used.
+    """
+    try:
+        cur = con.cursor()
+        cur.execute("SELECT 1;")
+        cur.close()
+        con.rollback()
+        return True
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        return False
+
+
+@contextlib.contextmanager
+def pooledconnection(**connection_params):
+    """
+    Borrow a connection from the process-wide pool for these connection parameters (the keyword
+    arguments of psycopg2.connect). Connections left idle for POOL_PROBE_IDLE_SECONDS are probed
+    before they are handed out and replaced if the server no longer answers, and the connection
+    is rolled back and returned to the pool on exit.
+    """
+    pool = _get_pool(connection_params)
+    pool.slots.acquire()
+    con = None
+    try:
+        con = pool.getconn()
+        yield con
+    finally:
+        if con is not None:
+            broken = not _is_healthy(con)
+            if not broken and con.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    con.rollback()
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    broken = True
+            pool.putconn(con, close=broken)
+        pool.slots.release()
+
+
+def closepools():
+    """
+    Close every pooled connection, e.g. before the process exits.
+    """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+
+
+def node_parameters(node):
+    """
+    Keyword arguments for psycopg2.connect (and pooledconnection) from a node connection string.
+    """
+    return psycopg2.extensions.parse_dsn(node)
+
+
+def _database_identity(cur):
+    # Two connection strings may name the same database, compare what the server reports instead
+    cur.execute("SELECT current_database(), pg_postmaster_start_time()::TEXT;")
+    return tuple(cur.fetchone())
+
+
+def connection_parameters(openconnection):
+    """
+    Keyword arguments for psycopg2.connect that open another connection to the same database.
+    """
+    info = openconnection.info
+    return dict(dbname=info.dbname, user=info.user, password=info.password, host=info.host, port=info.port)
+
+
+@timed('create_db')
+def create_db(dbname, user='postgres', password='root'):
+    if dbname in _known_databases:
+        return
+
+    # Connect to the default database
+    with pooledconnection(dbname='postgres', user=user, password=password, host='localhost') as con:
+        con.autocommit = True
+        cur = con.cursor()
+        try:
+            # Check if an existing database with the same name exists
+            cur.execute('SELECT COUNT(*) FROM pg_catalog.pg_database WHERE datname=%s', (dbname,))
+            count = cur.fetchone()[0]
+            if count == 0:
+                cur.execute('CREATE DATABASE %s' % (dbname,))  # Create the database
+            _known_databases.add(dbname)
+        finally:
+            # Clean up
+            cur.close()
+            con.autocommit = False
+
+
+def count_partitions(prefix, openconnection):
+    con = openconnection
+    cur = con.cursor()
+    # Only count prefix0, prefix1, ... so tables like range_part_backup are not mistaken for partitions
+    cur.execute("select count(*) from pg_stat_user_tables where relname ~ %s;", ('^' + prefix + '[0-9]+$',))
+    count = cur.fetchone()[0]
+    cur.close()
+    return count
+
+
+def _register_partitions(cur, prefix, ratingstablename, scheme, table_names, boundaries=None, partitionkey=None,
+                         boundarymode=None):
+    """
+    Record the layout of a freshly built set of partitions and drop the tables of the previous
+    layout that are not part of the new one. boundarymode is how range boundaries were chosen
+    ('equal' or 'quantile'). Runs in the caller's transaction; call
+    invalidate_partition_cache(prefix) once it is committed.
+    """
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS {PARTITION_REGISTRY_TABLE} (
+        prefix TEXT PRIMARY KEY,
+        ratingstablename TEXT NOT NULL,
+        scheme TEXT NOT NULL,
+        numberofpartitions INTEGER NOT NULL,
+        partitionkey TEXT,
+        boundaries DOUBLE PRECISION[],
+        boundarymode TEXT,
+        tablenames TEXT[] NOT NULL
+    );
+    """)
+    cur.execute(f"SELECT tablenames FROM {PARTITION_REGISTRY_TABLE} WHERE prefix = %s;", (prefix,))
+    previous = cur.fetchone()
+    if previous is not None:
+        for table_name in previous[0]:
+            if table_name not in table_names:
+                cur.execute(f"DROP TABLE IF EXISTS {table_name};")
+
+    # The zone maps and placement of the previous layout no longer describe the tables
+    for metadata_table in (PARTITION_ZONEMAP_TABLE, PARTITION_PLACEMENT_TABLE):
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (metadata_table,))
+        if cur.fetchone()[0]:
+            cur.execute(f"DELETE FROM {metadata_table} WHERE prefix = %s;", (prefix,))
+
+    cur.execute(f"""
+    INSERT INTO {PARTITION_REGISTRY_TABLE}
+        (prefix, ratingstablename, scheme, numberofpartitions, partitionkey, boundaries, tablenames, boundarymode)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (prefix) DO UPDATE SET
+        ratingstablename = EXCLUDED.ratingstablename,
+        scheme = EXCLUDED.scheme,
+        numberofpartitions = EXCLUDED.numberofpartitions,
+        partitionkey = EXCLUDED.partitionkey,
+        boundaries = EXCLUDED.boundaries,
+        tablenames = EXCLUDED.tablenames,
+        boundarymode = EXCLUDED.boundarymode;
+    """, (prefix, ratingstablename, scheme, len(table_names), partitionkey, boundaries, list(table_names),
+          boundarymode))
+
+
+def invalidate_partition_cache(prefix=None):
+    """
+    Forget the cached layout of one prefix, or of every prefix. Partitioning functions call this
+    after they commit; other processes sharing the database have to call it themselves when they
+    repartition.
+    """
+    for key in list(_partition_cache):
+        if prefix is None or key[1] == prefix:
+            del _partition_cache[key]
+
+
+def get_partition_info(prefix, openconnection):
+    """
+    Layout of the partitions with the given prefix: scheme, numberofpartitions, partitionkey,
+    boundaries, boundarymode, tablenames, zonemap (see _read_zonemap, None when the partitions
+    have none), placement ({tablename: node} for partitions on other nodes, None when all are
+    local) and trigger (whether installroutingtrigger routes the inserts into ratings on the
+    server). Read from the registry once and then served from the in-process cache. Partitions
+    not created through this module fall back to counting the tables in the catalog.
+    """
+    key = (openconnection.dsn, prefix)
+    info = _partition_cache.get(key)
+    if info is not None:
+        return info
+
+    cur = openconnection.cursor()
+    try:
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (PARTITION_REGISTRY_TABLE,))
+        row = None
+        if cur.fetchone()[0]:
+            cur.execute(f"""
+            SELECT ratingstablename, scheme, numberofpartitions, partitionkey, boundaries, tablenames, boundarymode
+            FROM {PARTITION_REGISTRY_TABLE} WHERE prefix = %s;
+            """, (prefix,))
+            row = cur.fetchone()
+        zonemap = _read_zonemap(cur, prefix) if row is not None else None
+        placement = _read_placement(cur, prefix) if row is not None else None
+        trigger = _has_routing_trigger(cur, row[0], prefix) if row is not None else False
+    finally:
+        cur.close()
+
+    if row is not None:
+        info = dict(ratingstablename=row[0], scheme=row[1], numberofpartitions=row[2],
+                    partitionkey=row[3], boundaries=row[4], tablenames=row[5], boundarymode=row[6],
+                    zonemap=zonemap, placement=placement, trigger=trigger)
+    else:
+        numberofpartitions = count_partitions(prefix, openconnection)
+        info = dict(ratingstablename=None, scheme=None, numberofpartitions=numberofpartitions,
+                    partitionkey=None, boundaries=None, boundarymode=None,
+                    tablenames=[prefix + str(i) for i in range(numberofpartitions)], zonemap=None,
+                    placement=None, trigger=False)
+    _partition_cache[key] = info
+    return info
+
+
+def _index_partitions(cur, table_names):
+    """
+    B-tree indexes on userid and movieid and a BRIN index on rating for every partition, followed
+    by ANALYZE. Meant to run once the partitions are filled, building an index over loaded rows is
+    cheaper than keeping it up to date row by row during the fill.
+    """
+    for table_name in table_names:
+        for suffix, definition in PARTITION_INDEXES:
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_{suffix} ON {table_name} {definition};")
+        cur.execute(f"ANALYZE {table_name};")
+
+
+def _create_zonemap_table(cur):
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS {PARTITION_ZONEMAP_TABLE} (
+        tablename TEXT PRIMARY KEY,
+        prefix TEXT NOT NULL,
+        rowcount BIGINT NOT NULL,
+        minuserid INTEGER,
+        maxuserid INTEGER,
+        minmovieid INTEGER,
+        maxmovieid INTEGER,
+        minrating REAL,
+        maxrating REAL
+    );
+    """)
+
+
+# Zone map of one table, as stored in PARTITION_ZONEMAP_TABLE after the table name and prefix
+ZONEMAP_QUERY = "SELECT COUNT(*), MIN(userid), MAX(userid), MIN(movieid), MAX(movieid), MIN(rating), MAX(rating) FROM {}"
+
+
+def _refresh_zonemap(cur, prefix, table_names):
+    """
+    Recompute the zone map (row count and min/max of every column) of the given partitions.
+    Runs in the caller's transaction; call invalidate_partition_cache(prefix) once it is committed.
+    """
+    _create_zonemap_table(cur)
+    cur.execute(f"DELETE FROM {PARTITION_ZONEMAP_TABLE} WHERE tablename = ANY(%s);", (list(table_names),))
+    selects = [f"""
+        SELECT '{table_name}', '{prefix}', COUNT(*), MIN(userid), MAX(userid), MIN(movieid), MAX(movieid),
+               MIN(rating), MAX(rating)
+        FROM {table_name}
+    """ for table_name in table_names]
+    cur.execute(f"INSERT INTO {PARTITION_ZONEMAP_TABLE} {' UNION ALL '.join(selects)};")
+
+
+def _store_zonemap(cur, prefix, zones):
+    """
+    Record zone maps computed elsewhere (e.g. on the node holding the partition), given as
+    {tablename: row of ZONEMAP_QUERY}.
+    """
+    _create_zonemap_table(cur)
+    cur.execute(f"DELETE FROM {PARTITION_ZONEMAP_TABLE} WHERE tablename = ANY(%s);", (list(zones),))
+    psycopg2.extras.execute_values(cur, f"INSERT INTO {PARTITION_ZONEMAP_TABLE} VALUES %s",
+                                   [(table_name, prefix, *zone) for table_name, zone in zones.items()])
+
+
+def _read_placement(cur, prefix):
+    """
+    Node of every partition with the given prefix that lives outside the coordinator database,
+    as {tablename: node}, or None if they are all local.
+    """
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (PARTITION_PLACEMENT_TABLE,))
+    if not cur.fetchone()[0]:
+        return None
+    cur.execute(f"SELECT tablename, node FROM {PARTITION_PLACEMENT_TABLE} WHERE prefix = %s;", (prefix,))
+    return dict(cur.fetchall()) or None
+
+
+def _store_placement(cur, prefix, placement):
+    """
+    Record the node of every partition in placement ({tablename: node}). Runs after
+    _register_partitions, which forgets the previous placement of the prefix. A routing trigger
+    can only write to local partitions, so the one of the prefix is dropped.
+    """
+    _drop_routing_trigger(cur, prefix)
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS {PARTITION_PLACEMENT_TABLE} (
+        tablename TEXT PRIMARY KEY,
+        prefix TEXT NOT NULL,
+        node TEXT NOT NULL
+    );
+    """)
+    psycopg2.extras.execute_values(cur, f"INSERT INTO {PARTITION_PLACEMENT_TABLE} (tablename, prefix, node) VALUES %s",
+                                   [(table_name, prefix, node) for table_name, node in placement.items()])
+
+
+def partition_connection_parameters(info, table_name, openconnection):
+    """
+    Keyword arguments for psycopg2.connect that open a connection to the database holding
+    table_name, one of the partitions described by info (see get_partition_info).
+    """
+    node = _partition_node(info, table_name)
+    if node is None:
+        return connection_parameters(openconnection)
+    return node_parameters(node)
+
+
+def _partition_node(info, table_name):
+    # Node holding table_name, None when it lives in the coordinator database
+    return (info.get('placement') or {}).get(table_name)
+
+
+def _insert_on_node(node, table_name, rows):
+    """
+    Insert (userid, movieid, rating) rows into a partition living on another node, over a pooled
+    connection to that node. The rows are committed there right away, before the caller commits
+    the main table: the two commits are not atomic.
+    """
+    with pooledconnection(**node_parameters(node)) as con:
+        cur = con.cursor()
+        try:
+            _insert_rows(cur, table_name, rows)
+            con.commit()
+        finally:
+            cur.close()
+
+
+def _read_zonemap(cur, prefix):
+    """
+    Zone maps of the partitions with the given prefix as {tablename: {'rowcount': n,
+    'userid': [min, max], 'movieid': [min, max], 'rating': [min, max]}}, or None if there are none.
+    """
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (PARTITION_ZONEMAP_TABLE,))
+    if not cur.fetchone()[0]:
+        return None
+    cur.execute(f"""
+    SELECT tablename, rowcount, minuserid, maxuserid, minmovieid, maxmovieid, minrating, maxrating
+    FROM {PARTITION_ZONEMAP_TABLE} WHERE prefix = %s;
+    """, (prefix,))
+    zonemap = {}
+    for row in cur.fetchall():
+        zonemap[row[0]] = dict(rowcount=row[1], userid=[row[2], row[3]], movieid=[row[4], row[5]],
+                               rating=[row[6], row[7]])
+    return zonemap or None
+
+
+def read_zonemap(prefix, openconnection):
+    """
+    Zone maps of the partitions with the given prefix as stored right now (see _read_zonemap).
+    The copy in get_partition_info is only widened by this process, so decisions that must see
+    the rows other connections inserted read them here.
+    """
+    cur = openconnection.cursor()
+    try:
+        return _read_zonemap(cur, prefix)
+    finally:
+        cur.close()
+
+
+def _widen_zonemap(cur, info, table_name, rows):
+    """
+    Widen the zone map of table_name to cover the (userid, movieid, rating) rows inserted into it,
+    in the database and in the cached layout. Does nothing for partitions without a zone map.
+    The cached entry is widened before the commit, a rolled back insert only leaves it too wide.
+    A routing trigger widens the stored zone map on the server, so then nothing is done here.
+    """
+    zone = (info.get('zonemap') or {}).get(table_name)
+    if zone is None or info.get('trigger'):
+        return
+    bounds = []
+    for position, column in enumerate(ZONEMAP_COLUMNS):
+        values = [row[position] for row in rows if row[position] is not None]
+        low = high = None
+        if values:
+            low, high = min(values), max(values)
+            if column == 'rating':
+                # Compare with what the REAL column actually stores
+                low, high = routing.as_real(low), routing.as_real(high)
+            current = zone[column]
+            zone[column] = [low if current[0] is None else min(current[0], low),
+                            high if current[1] is None else max(current[1], high)]
+        bounds.extend((low, high))
+    zone['rowcount'] += len(rows)
+    cur.execute(f"""
+    UPDATE {PARTITION_ZONEMAP_TABLE} SET rowcount = rowcount + %s,
+        minuserid = LEAST(minuserid, %s), maxuserid = GREATEST(maxuserid, %s),
+        minmovieid = LEAST(minmovieid, %s), maxmovieid = GREATEST(maxmovieid, %s),
+        minrating = LEAST(minrating, %s::REAL), maxrating = GREATEST(maxrating, %s::REAL)
+    WHERE tablename = %s;
+    """, (len(rows), *bounds, table_name))
+
+
+def _check_durability(durability, openconnection):
+    if durability not in DURABILITY_MODES:
+        raise ValueError(f"Unknown durability mode: {durability}")
+    # SET LOCAL and the SET LOGGED before the commit only take effect inside one transaction
+    if durability != 'logged' and openconnection.autocommit:
+        raise ValueError(f"Durability mode '{durability}' needs a connection that is not in autocommit mode")
+
+
+def _start_build(cur, durability):
+    """
+    Prepare the caller's transaction for a build in the given durability mode and return the
+    keyword to put between CREATE and TABLE for the tables it builds.
+    """
+    if durability == 'logged':
+        return ''
+    # The rows of an UNLOGGED table skip the WAL, and the commit does not wait for what is left
+    cur.execute("SET LOCAL synchronous_commit = off;")
+    return 'UNLOGGED '
+
+
+def _finish_build(cur, table_names, durability):
+    """
+    With 'deferred' durability, make the tables built by the caller crash-safe before it commits.
+    """
+    if durability == 'deferred':
+        for table_name in table_names:
+            cur.execute(f"ALTER TABLE {table_name} SET LOGGED;")
+
+
+def _check_build(build, openconnection):
+    if build not in BUILD_MODES:
+        raise ValueError(f"Unknown build mode: {build}")
+    # The lock on the ratings table and the swap only hold together inside one transaction
+    if build == 'shadow' and openconnection.autocommit:
+        raise ValueError("A 'shadow' build needs a connection that is not in autocommit mode")
+
+
+def _start_shadow_build(cur, ratingstablename, table_names, unlogged):
+    """
+    Create empty shadow copies of table_names and return their names. ratingstablename is locked
+    against writes until the commit, so no row inserted during the build is missing from the
+    shadow tables; readers of ratingstablename and of the live partitions are not blocked.
+    """
+    cur.execute(f"LOCK TABLE {ratingstablename} IN SHARE MODE;")
+    shadow_names = [table_name + SHADOW_SUFFIX for table_name in table_names]
+    for shadow_name in shadow_names:
+        cur.execute(f"DROP TABLE IF EXISTS {shadow_name};")
+        cur.execute(f"""
+        CREATE {unlogged}TABLE {shadow_name} (
+            userid INTEGER,
+            movieid INTEGER,
+            rating REAL
+        );
+        """)
+    return shadow_names
+
+
+def _swap_in_shadow(cur, prefix, table_names):
+    """
+    Replace table_names by their filled shadow copies, with their indexes and zone maps. This is
+    the only step of a shadow build that locks the live partitions, and it only renames.
+    """
+    for table_name in table_names:
+        cur.execute(f"DROP TABLE IF EXISTS {table_name};")
+        cur.execute(f"ALTER TABLE {table_name}{SHADOW_SUFFIX} RENAME TO {table_name};")
+        for suffix, _ in PARTITION_INDEXES:
+            cur.execute(f"ALTER INDEX IF EXISTS {table_name}{SHADOW_SUFFIX}_{suffix} RENAME TO {table_name}_{suffix};")
+
+    # Zone maps of the shadow tables were recorded under the shadow prefix
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (PARTITION_ZONEMAP_TABLE,))
+    if cur.fetchone()[0]:
+        cur.execute(f"""
+        UPDATE {PARTITION_ZONEMAP_TABLE} SET prefix = %s, tablename = left(tablename, -%s)
+        WHERE prefix = %s;
+        """, (prefix, len(SHADOW_SUFFIX), prefix + SHADOW_SUFFIX))
+
+
+def _create_meta_table(cur):
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS {RROBIN_META_TABLE} (
+        ratingstablename TEXT PRIMARY KEY,
+        row_count BIGINT NOT NULL,
+        numberofpartitions INTEGER NOT NULL
+    );
+    """)
+
+
+def _reset_row_counter(cur, ratingstablename):
+    """
+    Make sure the round robin metadata table exists and forget the counter of a (re)loaded table.
+    """
+    _create_meta_table(cur)
+    cur.execute(f"DELETE FROM {RROBIN_META_TABLE} WHERE ratingstablename = %s;", (ratingstablename,))
+
+
+def _seed_row_counter(cur, ratingstablename, prefix, openconnection):
+    """
+    Count the rows and partitions once and store them as the routing state of ratingstablename.
+    Used when no routing state was recorded for the table yet.
+    """
+    cur.execute(f"SELECT COUNT(*) FROM {ratingstablename};")
+    total_rows = cur.fetchone()[0]
+    numberofpartitions = get_partition_info(prefix, openconnection)['numberofpartitions']
+    cur.execute(f"""
+    INSERT INTO {RROBIN_META_TABLE} (ratingstablename, row_count, numberofpartitions)
+    VALUES (%s, %s, %s);
+    """, (ratingstablename, total_rows, numberofpartitions))
+    return total_rows, numberofpartitions
+
+
+def _bump_row_counter_query(ratingstablename, openconnection):
+    """
+    CTE that counts one more row of ratingstablename in the round robin metadata, so inserts that
+    do not route round robin still keep the counter equal to COUNT(*) of the table. Empty when
+    the round robin routing trigger counts the rows itself.
+    """
+    if _counter_kept_by_trigger(openconnection):
+        return ""
+    return f"""WITH bump AS (
+        UPDATE {RROBIN_META_TABLE} SET row_count = row_count + 1 WHERE ratingstablename = '{ratingstablename}'
+    )"""
+
+
+class _RatingsFileReader:
+    """
+    Read-only file adapter that turns 'userid::movieid::rating::timestamp' lines into the
+    tab-separated 'userid, movieid, rating' rows COPY expects, a chunk of lines at a time.
+    Blank lines are skipped, any other line without three fields raises a ValueError.
+    """
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, file, offset=0):
+        self._file = file
+        self._buffer = ''
+        self._pos = 0
+        # Byte offset the file view starts at, line numbers in errors count from there
+        self._offset = offset
+        self._lines = 0
+        # Time spent reading and reshaping lines, and the number of rows produced
+        self.parse_ns = 0
+        self.rows = 0
+
+    def _refill(self):
+        start = time.perf_counter_ns()
+        lines = self._file.readlines(self.CHUNK_SIZE)
+        rows = []
+        for k, line in enumerate(lines):
+            fields = line.split('::')
+            if len(fields) >= 3:
+                rows.append(f"{fields[0]}\t{fields[1]}\t{fields[2].strip()}\n")
+            elif line.strip():
+                where = f" after byte {self._offset}" if self._offset else ""
+                raise ValueError(f"Malformed ratings line {self._lines + k + 1}{where}: {line.rstrip()!r}")
+        self._lines += len(lines)
+        self._buffer = ''.join(rows)
+        self._pos = 0
+        self.rows += len(rows)
+        self.parse_ns += time.perf_counter_ns() - start
+        return len(lines) > 0
+
+    def read(self, size=-1):
+        while self._pos >= len(self._buffer):
+            if not self._refill():
+                return ''
+        if size is None or size < 0:
+            end = len(self._buffer)
+        else:
+            end = self._pos + size
+        data = self._buffer[self._pos:end]
+        self._pos += len(data)
+        return data
+
+
+class _ByteRangeFile:
+    """
+    Binary file view limited to the byte range [start, end), exposing readlines() like a text file.
+    end must fall on a line boundary.
+    """
+    def __init__(self, file, start, end):
+        self._file = file
+        self._file.seek(start)
+        self._remaining = end - start
+
+    def readlines(self, hint=-1):
+        if self._remaining <= 0:
+            return []
+        data = self._file.read(self._remaining if hint is None or hint < 0 else min(hint, self._remaining))
+        self._remaining -= len(data)
+        if self._remaining > 0 and not data.endswith(b'\n'):
+            tail = self._file.readline()
+            self._remaining -= len(tail)
+            data += tail
+        return data.decode().splitlines(True)
+
+
+def _split_file(ratingsfilepath, parts):
+    """
+    Split the file into at most `parts` byte ranges, each ending on a line boundary.
+    """
+    size = os.path.getsize(ratingsfilepath)
+    if size == 0:
+        return []
+    offsets = [0]
+    with open(ratingsfilepath, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for k in range(1, parts):
+            newline = mm.find(b'\n', max(k * size // parts, offsets[-1]))
+            if newline == -1:
+                break
+            if newline + 1 < size:
+                offsets.append(newline + 1)
+    offsets.append(size)
+    return [(offsets[k], offsets[k + 1]) for k in range(len(offsets) - 1) if offsets[k] < offsets[k + 1]]
+
+
+def _copy_file_range(connection_params, tablename, ratingsfilepath, start, end):
+    """
+    COPY one byte range of the ratings file into tablename over its own connection.
+    """
+    with pooledconnection(**connection_params) as con:
+        cur = con.cursor()
+        with open(ratingsfilepath, 'rb') as file, phase('loadratings.copy_part') as copy_phase:
+            reader = _RatingsFileReader(_ByteRangeFile(file, start, end), start)
+            cur.copy_expert(f"COPY {tablename} (userid, movieid, rating) FROM STDIN", reader,
+                            size=_RatingsFileReader.CHUNK_SIZE)
+            copy_phase.rows = reader.rows
+        record('loadratings.parse', reader.parse_ns, reader.rows)
+        with phase('loadratings.commit_part'):
+            con.commit()
+        cur.close()
+
+
+def _load_parallel(cur, ratingstablename, ratingsfilepath, openconnection, workers, durability='logged'):
+    """
+    Load the file with `workers` concurrent COPY streams into an UNLOGGED staging table, then swap
+    it in place of ratingstablename. The swap runs in the caller's transaction; the table is made
+    LOGGED there unless durability is 'unlogged'.
+    """
+    staging_table = f"{ratingstablename}_load"
+    connection_params = connection_parameters(openconnection)
+
+    # The staging table has to be committed so the worker connections can see it
+    cur.execute(f"DROP TABLE IF EXISTS {staging_table};")
+    cur.execute(f"""
+    CREATE UNLOGGED TABLE {staging_table} (
+        userid INTEGER,
+        movieid INTEGER,
+        rating REAL
+    );
+    """)
+    openconnection.commit()
+
+    try:
+        with phase('loadratings.split'):
+            ranges = _split_file(ratingsfilepath, workers)
+        with phase('loadratings.copy'):
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_copy_file_range, connection_params, staging_table, ratingsfilepath,
+                                       start, end)
+                           for start, end in ranges]
+                for future in futures:
+                    future.result()
+
+        with phase('loadratings.swap'):
+            cur.execute(f"DROP TABLE IF EXISTS {ratingstablename};")
+            if durability != 'unlogged':
+                cur.execute(f"ALTER TABLE {staging_table} SET LOGGED;")
+            cur.execute(f"ALTER TABLE {staging_table} RENAME TO {ratingstablename};")
+    except Exception:
+        openconnection.rollback()
+        cur.execute(f"DROP TABLE IF EXISTS {staging_table};")
+        openconnection.commit()
+        raise
+
+
+@timed('loadratings')
+def loadratings(ratingstablename, ratingsfilepath, openconnection, method='stream', workers=1, durability='logged'):
+    """
+    Load the '::' separated ratings file into a (userid, movieid, rating) table.
+
+    Args:
+        ratingstablename (str): Name of the main ratings table
+        ratingsfilepath (str): Path of the ratings file
+        openconnection: PostgreSQL connection object
+        method (str): 'stream' reshapes the file while it is read and COPYs straight into the final
+            3-column table, 'staging' loads the raw 7-column layout and drops the extra columns after
+        workers (int): With the 'stream' method, number of connections that COPY separate line-aligned
+            parts of the file in parallel into an UNLOGGED staging table that then replaces the table
+        durability (str): 'logged', 'unlogged' or 'deferred', see DURABILITY_MODES. An UNLOGGED
+            ratings table is emptied by Postgres after a crash
+    """
+    if method not in ('stream', 'staging'):
+        raise ValueError(f"Unknown load method: {method}")
+    _check_durability(durability, openconnection)
+    if workers > 1 and method != 'stream':
+        raise ValueError("Parallel loading is only supported by the 'stream' method")
+
+    # Ensure database exists before proceeding (checked once per process)
+    create_db(openconnection.info.dbname)
+
+    # Get cursor from the connection
+    cur = openconnection.cursor()
+
+    try:
+        if workers > 1:
+            # Parallel COPY into a staging table that is swapped in when every part is loaded
+            _load_parallel(cur, ratingstablename, ratingsfilepath, openconnection, workers, durability)
+            _start_build(cur, durability)
+        elif method == 'stream':
+            unlogged = _start_build(cur, durability)
+
+            # Step 1: Drop table if exists
+            cur.execute(f"DROP TABLE IF EXISTS {ratingstablename};")
+
+            # Step 2: Create the table with its final layout
+            cur.execute(f"""
+            CREATE {unlogged}TABLE {ratingstablename} (
+                userid INTEGER,
+                movieid INTEGER,
+                rating REAL
+            );
+            """)
+
+            # Step 3: COPY the reshaped rows, parsing the file one chunk at a time
+            # (the copy phase includes the parse time, which is also recorded on its own)
+            with open(ratingsfilepath, 'r') as file, phase('loadratings.copy') as copy_phase:
+                reader = _RatingsFileReader(file)
+                cur.copy_expert(f"COPY {ratingstablename} (userid, movieid, rating) FROM STDIN",
+                                reader, size=_RatingsFileReader.CHUNK_SIZE)
+                copy_phase.rows = reader.rows
+            record('loadratings.parse', reader.parse_ns, reader.rows)
+        else:
+            unlogged = _start_build(cur, durability)
+
+            # Step 1: Drop table if exists
+            cur.execute(f"DROP TABLE IF EXISTS {ratingstablename};")
+
+            # Build table structure with parsing columns
+            table_schema = f"""
+            CREATE {unlogged}TABLE {ratingstablename} (
+                userid INTEGER,
+                extra1 CHAR,
+                movieid INTEGER, 
+                extra2 CHAR,
+                rating REAL,
+                extra3 CHAR,
+                timestamp BIGINT
+            );
+            """
+            cur.execute(table_schema)
+
+            # Step 2: Use COPY FROM for fast bulk loading
+            with open(ratingsfilepath, 'r') as file, phase('loadratings.copy') as copy_phase:
+                cur.copy_from(file, ratingstablename, sep=':')
+                copy_phase.rows = cur.rowcount
+
+            # Step 3: Remove unnecessary columns
+            cleanup_query = f"""
+            ALTER TABLE {ratingstablename} 
+            DROP COLUMN extra1,
+            DROP COLUMN extra2,
+            DROP COLUMN extra3,
+            DROP COLUMN timestamp;
+            """
+            with phase('loadratings.cleanup'):
+                cur.execute(cleanup_query)
+
+        if workers == 1:
+            with phase('loadratings.set_logged'):
+                _finish_build(cur, [ratingstablename], durability)
+
+        # The table was rebuilt, so any round robin counter kept for it is stale, and native
+        # partitions of the old table were dropped along with it
+        _reset_row_counter(cur, ratingstablename)
+        _forget_native_partitions(cur, ratingstablename)
+
+        # Commit the transaction
+        with phase('loadratings.commit'):
+            openconnection.commit()
+        # Native partitions and routing triggers were dropped along with the old table
+        invalidate_partition_cache()
+
+    except Exception as e:
+        # Rollback in case of error
+        openconnection.rollback()
+        print(f"Data loading failed: {str(e)}")
+        raise e
+
+    finally:
+        # Close cursor (but not connection as per requirement)
+        cur.close()
+
+
+def _range_bounds(numberofpartitions):
+    """
+    Boundaries of the equal-width rating intervals: partition i covers (bounds[i], bounds[i + 1]],
+    except partition 0 which also includes bounds[0].
+    """
+    interval = 5.0 / numberofpartitions
+    return [i * interval for i in range(numberofpartitions + 1)]
+
+
+def _quantile_bounds(cur, ratingstablename, numberofpartitions, samplepercent=None):
+    """
+    Equi-depth boundaries: the inner bounds are the 1/n, 2/n, ... quantiles of the ratings, so
+    every partition receives about the same number of rows however skewed the ratings are.
+    With samplepercent the quantiles are estimated from a TABLESAMPLE of the table.
+    """
+    fractions = [i / numberofpartitions for i in range(1, numberofpartitions)]
+    if not fractions:
+        return [0.0, 5.0]
+    sample = f" TABLESAMPLE SYSTEM ({float(samplepercent)})" if samplepercent else ""
+    cur.execute(f"""
+    SELECT percentile_disc(%s::DOUBLE PRECISION[]) WITHIN GROUP (ORDER BY rating)
+    FROM {ratingstablename}{sample}
+    WHERE rating >= 0 AND rating <= 5;
+    """, (fractions,))
+    quantiles = cur.fetchone()[0]
+    if quantiles is None:
+        return _range_bounds(numberofpartitions)
+    return [0.0] + [float(q) for q in quantiles] + [5.0]
+
+
+def _compute_range_bounds(cur, ratingstablename, numberofpartitions, boundaries, samplepercent=None):
+    if boundaries == 'equal':
+        return _range_bounds(numberofpartitions)
+    if boundaries == 'quantile':
+        return _quantile_bounds(cur, ratingstablename, numberofpartitions, samplepercent)
+    raise ValueError(f"Unknown range boundaries: {boundaries}")
+
+
+# Live row count of a table as tracked by the statistics collector, falling back to the planner
+# estimate of the last ANALYZE when the statistics were reset
+ESTIMATED_COUNT_QUERY = """
+SELECT CASE WHEN s.n_live_tup > 0 OR c.reltuples <= 0 THEN s.n_live_tup ELSE c.reltuples::BIGINT END
+FROM pg_class c JOIN pg_stat_user_tables s ON s.relid = c.oid
+WHERE c.oid = '{}'::regclass
+"""
+
+
+def partitionbalance(prefix, openconnection, estimate=False):
+    """
+    Row count of every partition with the given prefix and how far the largest one is from the
+    mean (1.0 means perfectly balanced). With estimate, the counts come from the table statistics
+    instead of a scan of every partition; they can lag a moment behind the latest writes.
+    """
+    info = get_partition_info(prefix, openconnection)
+    count_query = ESTIMATED_COUNT_QUERY if estimate else "SELECT COUNT(*) FROM {}"
+    cur = openconnection.cursor()
+    try:
+        counts = []
+        for table_name in info['tablenames']:
+            node = _partition_node(info, table_name)
+            if node is None:
+                cur.execute(count_query.format(table_name) + ";")
+                counts.append(cur.fetchone()[0])
+                continue
+            with pooledconnection(**node_parameters(node)) as con:
+                node_cur = con.cursor()
+                node_cur.execute(count_query.format(table_name) + ";")
+                counts.append(node_cur.fetchone()[0])
+                node_cur.close()
+    finally:
+        cur.close()
+    mean = sum(counts) / len(counts) if counts else 0
+    skew = max(counts) / mean if mean else 1.0
+    return dict(counts=counts, skew=skew)
+
+
+def _range_bucket_expression(bounds):
+    """
+    SQL expression giving the range partition index of a row, with the same boundary rules as the
+    per-partition WHERE clauses (partition 0 includes its lower bound, every partition its upper bound).
+    """
+    cases = " ".join(f"WHEN rating <= {bounds[i + 1]} THEN {i}" for i in range(len(bounds) - 1))
+    return f"CASE {cases} END"
+
+
+class _PartitionSpooler:
+    """
+    File-like target of COPY ... TO STDOUT for rows starting with their partition index. Every
+    row goes, without the index, to the spool file of its partition, in COPY text format.
+    """
+
+    def __init__(self, numberofpartitions):
+        self.spools = [tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES) for _ in range(numberofpartitions)]
+        self.rows = [0] * numberofpartitions
+        self._pending = b''
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        lines = (self._pending + data).split(b'\n')
+        self._pending = lines.pop()
+        for line in lines:
+            part, _, row = line.partition(b'\t')
+            index = int(part)
+            self.spools[index].write(row + b'\n')
+            self.rows[index] += 1
+
+    def rewind(self):
+        for spool in self.spools:
+            spool.seek(0)
+
+    def close(self):
+        for spool in self.spools:
+            spool.close()
+
+
+def _fan_out_copy(cur, source_query, table_names):
+    """
+    Copy every row of source_query into one of the given tables, reading the source a single time.
+
+    source_query must return a 'part' column holding the index of the target table followed by
+    userid, movieid, rating. It is exported once with COPY ... TO STDOUT and split into one spool
+    file per table (see _PartitionSpooler), then every spool is copied into its table. Unlike
+    INSERT ... SELECT, no partition re-reads the source and no rows are materialized server side.
+
+    Returns:
+        list with the number of rows copied into every table
+    """
+    spooler = _PartitionSpooler(len(table_names))
+    try:
+        cur.copy_expert(f"COPY ({source_query}) TO STDOUT", spooler)
+        spooler.rewind()
+        for table_name, spool in zip(table_names, spooler.spools):
+            cur.copy_expert(f"COPY {table_name} (userid, movieid, rating) FROM STDIN", spool)
+        return spooler.rows
+    finally:
+        spooler.close()
+
+
+def _load_on_node(node, table_name, spool, durability, indexes):
+    """
+    COPY the spooled rows of one partition into its shadow table on the node that owns it and
+    commit. Returns the identity of the node database and, with indexes, the zone map of the table.
+    """
+    with pooledconnection(**node_parameters(node)) as con:
+        cur = con.cursor()
+        try:
+            unlogged = _start_build(cur, durability)
+            shadow_name = table_name + SHADOW_SUFFIX
+            cur.execute(f"DROP TABLE IF EXISTS {shadow_name};")
+            cur.execute(f"""
+            CREATE {unlogged}TABLE {shadow_name} (
+                userid INTEGER,
+                movieid INTEGER,
+                rating REAL
+            );
+            """)
+            cur.copy_expert(f"COPY {shadow_name} (userid, movieid, rating) FROM STDIN", spool)
+            _finish_build(cur, [shadow_name], durability)
+            zone = None
+            if indexes:
+                _index_partitions(cur, [shadow_name])
+                cur.execute(ZONEMAP_QUERY.format(shadow_name) + ";")
+                zone = cur.fetchone()
+            identity = _database_identity(cur)
+            con.commit()
+            return identity, zone
+        finally:
+            cur.close()
+
+
+def _swap_on_node(node, prefix, table_name):
+    with pooledconnection(**node_parameters(node)) as con:
+        cur = con.cursor()
+        try:
+            _swap_in_shadow(cur, prefix, [table_name])
+            con.commit()
+        finally:
+            cur.close()
+
+
+def _distribute_partitions(cur, name, prefix, source_query, table_names, nodes, durability, indexes):
+    """
+    Build table_names on the given nodes, partition i on nodes[i % len(nodes)].
+
+    source_query yields (part, userid, movieid, rating) rows from the coordinator. It is read once
+    and split into one spool file per partition, then every partition is loaded into a shadow
+    table on its node, all partitions in parallel over pooled connections, and finally every node
+    swaps its shadow tables in (the coordinator database in the caller's transaction). Copies of
+    the partitions left in the coordinator database (when it is not their node) are dropped in the
+    caller's transaction.
+
+    Returns the placement {tablename: node}, the database identity of every partition and, with
+    indexes, the zone maps of the partitions.
+    """
+    placement = {table_name: nodes[i % len(nodes)] for i, table_name in enumerate(table_names)}
+    spooler = _PartitionSpooler(len(table_names))
+    try:
+        with phase(f'{name}.export') as export_phase:
+            cur.copy_expert(f"COPY ({source_query}) TO STDOUT", spooler)
+            export_phase.rows = sum(spooler.rows)
+        spooler.rewind()
+
+        with phase(f'{name}.ship', rows=sum(spooler.rows)):
+            with ThreadPoolExecutor(max_workers=min(len(table_names), POOL_MAX_CONNECTIONS)) as pool:
+                futures = [pool.submit(_load_on_node, placement[table_name], table_name, spooler.spools[i],
+                                       durability, indexes)
+                           for i, table_name in enumerate(table_names)]
+                results = [future.result() for future in futures]
+    finally:
+        spooler.close()
+
+    identities = {table_name: identity for table_name, (identity, _) in zip(table_names, results)}
+    zones = {table_name: zone for table_name, (_, zone) in zip(table_names, results)} if indexes else None
+    coordinator = _database_identity(cur)
+
+    with phase(f'{name}.swap'):
+        # A node that is the coordinator database swaps in the caller's transaction: it may hold
+        # locks on the old partitions (e.g. after unpartitioning ratings) another connection would wait for
+        local_names = [table_name for table_name in table_names if identities[table_name] == coordinator]
+        _swap_in_shadow(cur, prefix, local_names)
+        with ThreadPoolExecutor(max_workers=min(len(table_names), POOL_MAX_CONNECTIONS)) as pool:
+            for future in [pool.submit(_swap_on_node, placement[table_name], prefix, table_name)
+                           for table_name in table_names if table_name not in local_names]:
+                future.result()
+
+    for table_name in table_names:
+        if identities[table_name] != coordinator:
+            cur.execute(f"DROP TABLE IF EXISTS {table_name};")
+    return placement, identities, zones
+
+
+def _drop_stale_partitions(previous, placement, identities):
+    """
+    Drop the tables a previous placement left on nodes that no longer hold them. Runs after the
+    new layout is committed; a node that cannot be reached only gets a message.
+
+    Args:
+        previous (dict): Previous placement {tablename: node}
+        placement (dict): New placement {tablename: node}, empty for a local layout
+        identities (dict): Database identity of the new home of every partition
+    """
+    for table_name, node in (previous or {}).items():
+        if placement.get(table_name) == node:
+            continue
+        try:
+            with pooledconnection(**node_parameters(node)) as con:
+                cur = con.cursor()
+                try:
+                    # The old node may be another name for the database now holding the table
+                    if _database_identity(cur) != identities.get(table_name):
+                        cur.execute(f"DROP TABLE IF EXISTS {table_name};")
+                        con.commit()
+                finally:
+                    cur.close()
+        except psycopg2.Error as e:
+            print(f"Could not drop {table_name} from its previous node: {str(e)}")
+
+
+def _local_identities(cur, table_names, previous):
+    """
+    Identities to pass to _drop_stale_partitions for a layout built in the coordinator database:
+    every partition a previous placement put on another node now lives here. Empty when there
+    was no previous placement.
+    """
+    return dict.fromkeys(table_names, _database_identity(cur)) if previous else {}
+
+
+def _next_float4(value):
+    """
+    Smallest REAL number strictly greater than the non-negative value. That is value's own REAL
+    rounding when it rounds up, the REAL after it otherwise.
+    """
+    rounded = routing.as_real(value)
+    if rounded > value:
+        return rounded
+    bits = struct.unpack('<I', struct.pack('<f', rounded))[0]
+    return struct.unpack('<f', struct.pack('<I', bits + 1))[0]
+
+
+def _is_partitioned_table(cur, tablename):
+    cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s);", (tablename,))
+    row = cur.fetchone()
+    return row is not None and row[0]
+
+
+def _unpartition_table(cur, ratingstablename):
+    """
+    Turn a natively partitioned ratings table back into a plain table holding the same rows, with
+    the routing triggers it had. Returns whether the table was recreated.
+    """
+    if not _is_partitioned_table(cur, ratingstablename):
+        return False
+    triggers = _saved_routing_triggers(cur, ratingstablename)
+    cur.execute(f"CREATE TABLE {ratingstablename}__plain AS SELECT userid, movieid, rating FROM {ratingstablename};")
+    cur.execute(f"DROP TABLE {ratingstablename};")
+    cur.execute(f"ALTER TABLE {ratingstablename}__plain RENAME TO {ratingstablename};")
+    _restore_routing_triggers(cur, ratingstablename, triggers)
+    return True
+
+
+def _forget_native_partitions(cur, ratingstablename):
+    """
+    Drop the registry entries of native partitions that belonged to ratingstablename, used when the
+    table (and with it its partitions) is dropped. Returns the prefixes that were removed.
+    """
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (PARTITION_REGISTRY_TABLE,))
+    if not cur.fetchone()[0]:
+        return []
+    cur.execute(f"""
+    DELETE FROM {PARTITION_REGISTRY_TABLE}
+    WHERE ratingstablename = %s AND scheme = 'range_native'
+    RETURNING prefix;
+    """, (ratingstablename,))
+    return [row[0] for row in cur.fetchall()]
+
+
+def _build_native_range(cur, ratingstablename, prefix, table_names, bounds, unlogged=''):
+    """
+    Rebuild ratingstablename as a PARTITION BY RANGE (rating) table whose partitions are table_names.
+
+    Native range partitions include their lower bound and exclude their upper bound, so every
+    bound is replaced by the smallest REAL value above it: partition i then holds exactly bounds[i] < rating <= bounds[i + 1]
+    (bounds[0] <= rating for partition 0), the same rows as the copy-based layout. Ratings outside
+    [0, 5] go to a default partition so no row of the original table is lost. With
+    unlogged='UNLOGGED ' the partitions are created UNLOGGED.
+
+    The routing triggers of other layouts are recreated on the new table. The one of the range
+    layout (prefix) is not, Postgres routes its rows now.
+    """
+    native_table = f"{ratingstablename}__native"
+    default_table = f"{ratingstablename}_default"
+    triggers = [(trigger_prefix, function_name)
+                for trigger_prefix, function_name in _saved_routing_triggers(cur, ratingstablename)
+                if trigger_prefix != prefix]
+
+    cur.execute(f"DROP TABLE IF EXISTS {native_table};")
+    cur.execute(f"""
+        CREATE TABLE {native_table} (
+            userid INTEGER,
+            movieid INTEGER,
+            rating REAL
+        ) PARTITION BY RANGE (rating);
+    """)
+    for i, table_name in enumerate(table_names):
+        lower = routing.as_real(bounds[i]) if i == 0 else _next_float4(bounds[i])
+        upper = _next_float4(bounds[i + 1])
+        cur.execute(f"""
+            CREATE {unlogged}TABLE {table_name}__native PARTITION OF {native_table}
+            FOR VALUES FROM ({lower!r}) TO ({upper!r});
+        """)
+    cur.execute(f"CREATE {unlogged}TABLE {default_table}__native PARTITION OF {native_table} DEFAULT;")
+
+    # Postgres routes every row to its partition while the new table is filled
+    cur.execute(f"""
+        INSERT INTO {native_table} (userid, movieid, rating)
+        SELECT userid, movieid, rating FROM {ratingstablename};
+    """)
+
+    # Swap the new tables in; dropping a partitioned ratings table also drops its old partitions
+    cur.execute(f"DROP TABLE {ratingstablename};")
+    cur.execute(f"DROP TABLE IF EXISTS {default_table};")
+    for table_name in table_names:
+        cur.execute(f"DROP TABLE IF EXISTS {table_name};")
+        cur.execute(f"ALTER TABLE {table_name}__native RENAME TO {table_name};")
+    cur.execute(f"ALTER TABLE {default_table}__native RENAME TO {default_table};")
+    cur.execute(f"ALTER TABLE {native_table} RENAME TO {ratingstablename};")
+    _restore_routing_triggers(cur, ratingstablename, triggers)
+
+
+@timed('rangepartition')
+def rangepartition(ratingstablename, numberofpartitions, openconnection, method='single_pass', backend='copy',
+                   boundaries='equal', samplepercent=None, indexes=False, durability='logged', build='inplace',
+                   nodes=None):
+    """
+    Function to create range partitions for a ratings table based on the Rating value.
+
+    Args:
+        ratingstablename (str): Name of the main ratings table
+        numberofpartitions (int): Number of partitions to create
+        openconnection: PostgreSQL connection object
+        method (str): 'single_pass' reads the ratings table once and copies every row to its
+            partition (see _fan_out_copy), 'multi_pass' runs one INSERT ... SELECT per partition
+        backend (str): 'copy' fills standalone range_partI tables next to ratings, 'native' rebuilds
+            ratings as a PARTITION BY RANGE (rating) table with range_partI as its partitions, so
+            Postgres routes inserts and prunes partitions itself
+        boundaries (str): 'equal' splits [0, 5] into equal-width intervals, 'quantile' uses the
+            rating quantiles so every partition gets about the same number of rows
+        samplepercent (float): With 'quantile', estimate the quantiles from this percentage of
+            the table instead of reading all of it
+        indexes (bool): Once the partitions are filled, index them (B-tree on userid and movieid,
+            BRIN on rating), ANALYZE them and record their zone maps for partition pruning
+        durability (str): 'logged', 'unlogged' or 'deferred', see DURABILITY_MODES. 'unlogged'
+            partitions skip the WAL and are emptied by Postgres after a crash, 'deferred' ones
+            are built the same way and made LOGGED before the commit
+        build (str): 'inplace' drops and refills range_partI, so readers wait for the whole build.
+            'shadow' fills range_partI__new tables while range_partI stay readable and swaps the
+            names right before the commit; inserts into ratings wait until then, so it needs a
+            connection outside autocommit mode. The 'native' backend always builds this way
+        nodes (list): Connection strings of the databases to place the partitions on, partition i
+            going to nodes[i % len(nodes)] (see _distribute_partitions). The placement is recorded
+            so inserts and queries reach every partition on its node. Needs the 'copy' backend;
+            the partitions are always built in shadow tables on their node and swapped in there
+
+    Returns:
+        With 'quantile' boundaries, the partition sizes and balance as given by partitionbalance
+    """
+    if method not in ('single_pass', 'multi_pass'):
+        raise ValueError(f"Unknown range partitioning method: {method}")
+    if backend not in ('copy', 'native'):
+        raise ValueError(f"Unknown range partitioning backend: {backend}")
+    _check_durability(durability, openconnection)
+    _check_build(build, openconnection)
+    if nodes and backend != 'copy':
+        raise ValueError("Partitions can only be placed on other nodes with the 'copy' backend")
+
+    RANGE_TABLE_PREFIX = 'range_part'
+    cur = openconnection.cursor()
+
+    try:
+        # rangeinsert keeps the round robin row counter up to date, so the table has to exist
+        _create_meta_table(cur)
+        unlogged = _start_build(cur, durability)
+        previous_placement = get_partition_info(RANGE_TABLE_PREFIX, openconnection)['placement']
+
+        with phase('rangepartition.bounds'):
+            bounds = _compute_range_bounds(cur, ratingstablename, numberofpartitions, boundaries, samplepercent)
+        table_names = [f"{RANGE_TABLE_PREFIX}{i}" for i in range(numberofpartitions)]
+
+        if backend == 'native':
+            if any(bounds[i] >= bounds[i + 1] for i in range(numberofpartitions)):
+                raise ValueError(f"Native partitions need distinct boundaries, got {bounds}")
+            with phase('rangepartition.native_build'):
+                _build_native_range(cur, ratingstablename, RANGE_TABLE_PREFIX, table_names, bounds, unlogged)
+            recreated = True
+        elif nodes:
+            with phase('rangepartition.prepare'):
+                recreated = _unpartition_table(cur, ratingstablename)
+            placement, identities, zones = _distribute_partitions(cur, 'rangepartition', RANGE_TABLE_PREFIX, f"""
+                SELECT {_range_bucket_expression(bounds)} AS part, userid, movieid, rating
+                FROM {ratingstablename}
+                WHERE rating >= {bounds[0]} AND rating <= {bounds[-1]}
+            """, table_names, nodes, durability, indexes)
+        else:
+            with phase('rangepartition.prepare'):
+                # A natively partitioned ratings table owns the range_partI tables, turn it back first
+                recreated = _unpartition_table(cur, ratingstablename)
+
+                if build == 'shadow':
+                    target_names = _start_shadow_build(cur, ratingstablename, table_names, unlogged)
+                else:
+                    target_names = table_names
+                    for i in range(numberofpartitions):
+                        cur.execute(f"DROP TABLE IF EXISTS {RANGE_TABLE_PREFIX}{i};")
+
+                    for table_name in table_names:
+                        cur.execute(f"""
+                            CREATE {unlogged}TABLE IF NOT EXISTS {table_name} (
+                                userid INTEGER,
+                                movieid INTEGER,
+                                rating REAL
+                            );
+                        """)
+
+            if method == 'single_pass':
+                with phase('rangepartition.fill') as fill_phase:
+                    fill_phase.rows = sum(_fan_out_copy(cur, f"""
+                        SELECT {_range_bucket_expression(bounds)} AS part, userid, movieid, rating
+                        FROM {ratingstablename}
+                        WHERE rating >= {bounds[0]} AND rating <= {bounds[-1]}
+                    """, target_names))
+            else:
+                for i, table_name in enumerate(target_names):
+                    with phase('rangepartition.insert') as insert_phase:
+                        if i == 0:
+                            cur.execute(f"""
+                                INSERT INTO {table_name}
+                                SELECT * FROM {ratingstablename}
+                                WHERE rating >= {bounds[i]} AND rating <= {bounds[i + 1]};
+                            """)
+                        else:
+                            cur.execute(f"""
+                                INSERT INTO {table_name}
+                                SELECT * FROM {ratingstablename}
+                                WHERE rating > {bounds[i]} AND rating <= {bounds[i + 1]};
+                            """)
+                        insert_phase.rows = cur.rowcount
+
+        if nodes:
+            _register_partitions(cur, RANGE_TABLE_PREFIX, ratingstablename, 'range', table_names, bounds, 'rating',
+                                 boundaries)
+            _store_placement(cur, RANGE_TABLE_PREFIX, placement)
+            if indexes:
+                _store_zonemap(cur, RANGE_TABLE_PREFIX, zones)
+        else:
+            if backend == 'native':
+                built_names = table_names + [f"{ratingstablename}_default"]
+            else:
+                built_names = target_names
+            shadow = backend == 'copy' and build == 'shadow'
+
+            with phase('rangepartition.set_logged'):
+                _finish_build(cur, built_names, durability)
+
+            if indexes:
+                # Shadow tables are indexed before the swap, so the swap itself stays short
+                with phase('rangepartition.index'):
+                    _index_partitions(cur, target_names if shadow else table_names)
+                    if shadow:
+                        _refresh_zonemap(cur, RANGE_TABLE_PREFIX + SHADOW_SUFFIX, target_names)
+
+            _register_partitions(cur, RANGE_TABLE_PREFIX, ratingstablename,
+                                 'range_native' if backend == 'native' else 'range', table_names, bounds, 'rating',
+                                 boundaries)
+
+            if shadow:
+                with phase('rangepartition.swap'):
+                    _swap_in_shadow(cur, RANGE_TABLE_PREFIX, table_names)
+            elif indexes:
+                with phase('rangepartition.zonemap'):
+                    _refresh_zonemap(cur, RANGE_TABLE_PREFIX, table_names)
+
+            placement = {}
+            identities = _local_identities(cur, table_names, previous_placement)
+
+        with phase('rangepartition.commit'):
+            openconnection.commit()
+        # A recreated ratings table changes the routing triggers seen by the other layouts as well
+        invalidate_partition_cache(None if recreated else RANGE_TABLE_PREFIX)
+        _drop_stale_partitions(previous_placement, placement, identities)
+
+        if boundaries == 'quantile':
+            return partitionbalance(RANGE_TABLE_PREFIX, openconnection)
+
+    except Exception as e:
+        openconnection.rollback()
+        print(f"Error in rangepartition: {str(e)}")
+        raise
+
+    finally:
+        cur.close()
+
+@timed('roundrobinpartition')
+def roundrobinpartition(ratingstablename, numberofpartitions, openconnection, method='single_pass', indexes=False,
+                        durability='logged', build='inplace', nodes=None):
+    """
+    Function to create partitions of main table using round robin approach.
+
+    Args:
+        ratingstablename (str): Name of the main ratings table
+        numberofpartitions (int): Number of partitions to create
+        openconnection: PostgreSQL connection object
+        method (str): 'single_pass' numbers the rows once and copies every row to its partition
+            (see _fan_out_copy), 'multi_pass' runs the ROW_NUMBER() scan again for every partition
+        indexes (bool): Index, ANALYZE and zone map the partitions once they are filled, as in rangepartition
+        durability (str): 'logged', 'unlogged' or 'deferred', as in rangepartition
+        build (str): 'inplace' or 'shadow', as in rangepartition
+        nodes (list): Connection strings of the databases to place the partitions on, as in rangepartition
+    """
+    if method not in ('single_pass', 'multi_pass'):
+        raise ValueError(f"Unknown round robin partitioning method: {method}")
+    _check_durability(durability, openconnection)
+    _check_build(build, openconnection)
+
+    cur = openconnection.cursor()
+    RROBIN_TABLE_PREFIX = 'rrobin_part'
+
+    try:
+        unlogged = _start_build(cur, durability)
+        previous_placement = get_partition_info(RROBIN_TABLE_PREFIX, openconnection)['placement']
+
+        # Step 1: Create partition tables
+        table_names = [RROBIN_TABLE_PREFIX + str(i) for i in range(numberofpartitions)]
+        if nodes:
+            # Number the rows once and ship every partition to its node
+            placement, identities, zones = _distribute_partitions(cur, 'roundrobinpartition', RROBIN_TABLE_PREFIX, f"""
+                SELECT (ROW_NUMBER() OVER() - 1) % {numberofpartitions} AS part, userid, movieid, rating
+                FROM {ratingstablename}
+            """, table_names, nodes, durability, indexes)
+        else:
+            with phase('roundrobinpartition.prepare'):
+                if build == 'shadow':
+                    target_names = _start_shadow_build(cur, ratingstablename, table_names, unlogged)
+                else:
+                    target_names = table_names
+                    for i in range(numberofpartitions):
+                        table_name = RROBIN_TABLE_PREFIX + str(i)
+                        create_table_query = f"""
+                        CREATE {unlogged}TABLE IF NOT EXISTS {table_name} (
+                            userid INTEGER,
+                            movieid INTEGER,
+                            rating REAL
+                        );
+                        """
+                        cur.execute(create_table_query)
+
+                        # Clear existing data if any (TRUNCATE leaves no dead tuples behind)
+                        cur.execute(f"TRUNCATE {table_name};")
+
+                        # Indexes of an earlier indexed build would be kept up to date row by row
+                        # during the fill; with indexes they are built again once it is done
+                        for suffix, _ in PARTITION_INDEXES:
+                            cur.execute(f"DROP INDEX IF EXISTS {table_name}_{suffix};")
+
+                        # A table kept from an earlier build may have the other persistence, switching
+                        # it while it is empty costs nothing (and nothing at all if it already matches)
+                        cur.execute(f"ALTER TABLE {table_name} SET {'UNLOGGED' if unlogged else 'LOGGED'};")
+
+            # Step 2: Distribute data using round robin approach
+            # Use ROW_NUMBER() to assign sequential numbers to rows
+            # Then use modulo operation to distribute to partitions
+            if method == 'single_pass':
+                with phase('roundrobinpartition.fill') as fill_phase:
+                    fill_phase.rows = sum(_fan_out_copy(cur, f"""
+                        SELECT (ROW_NUMBER() OVER() - 1) % {numberofpartitions} AS part, userid, movieid, rating
+                        FROM {ratingstablename}
+                    """, target_names))
+            else:
+                for i in range(numberofpartitions):
+                    table_name = target_names[i]
+
+                    insert_query = f"""
+                    INSERT INTO {table_name} (userid, movieid, rating)
+                    SELECT userid, movieid, rating 
+                    FROM (
+                        SELECT userid, movieid, rating, 
+                               ROW_NUMBER() OVER() as row_num
+                        FROM {ratingstablename}
+                    ) as numbered_rows
+                    WHERE (row_num - 1) % {numberofpartitions} = {i};
+                    """
+                    with phase('roundrobinpartition.insert') as insert_phase:
+                        cur.execute(insert_query)
+                        insert_phase.rows = cur.rowcount
+
+            with phase('roundrobinpartition.set_logged'):
+                _finish_build(cur, target_names, durability)
+
+            if indexes:
+                with phase('roundrobinpartition.index'):
+                    _index_partitions(cur, target_names)
+                    if build == 'shadow':
+                        _refresh_zonemap(cur, RROBIN_TABLE_PREFIX + SHADOW_SUFFIX, target_names)
+
+            placement = {}
+            identities = _local_identities(cur, table_names, previous_placement)
+
+        # Step 3: Record the routing state used by roundrobininsert
+        with phase('roundrobinpartition.register'):
+            _reset_row_counter(cur, ratingstablename)
+            cur.execute(f"""
+            INSERT INTO {RROBIN_META_TABLE} (ratingstablename, row_count, numberofpartitions)
+            SELECT %s, COUNT(*), %s FROM {ratingstablename};
+            """, (ratingstablename, numberofpartitions))
+            _register_partitions(cur, RROBIN_TABLE_PREFIX, ratingstablename, 'roundrobin', table_names)
+
+        if nodes:
+            _store_placement(cur, RROBIN_TABLE_PREFIX, placement)
+            if indexes:
+                _store_zonemap(cur, RROBIN_TABLE_PREFIX, zones)
+        elif build == 'shadow':
+            with phase('roundrobinpartition.swap'):
+                _swap_in_shadow(cur, RROBIN_TABLE_PREFIX, table_names)
+        elif indexes:
+            with phase('roundrobinpartition.zonemap'):
+                _refresh_zonemap(cur, RROBIN_TABLE_PREFIX, table_names)
+
+        # Commit the transaction
+        with phase('roundrobinpartition.commit'):
+            openconnection.commit()
+        invalidate_partition_cache(RROBIN_TABLE_PREFIX)
+        _drop_stale_partitions(previous_placement, placement, identities)
+
+    except Exception as e:
+        # Rollback in case of error
+        openconnection.rollback()
+        print(f"Error creating round robin partitions: {str(e)}")
+        raise e
+
+    finally:
+        # Close cursor (but not connection as per requirement)
+        cur.close()
+
+
+class _QueueReader:
+    """
+    File-like source of COPY ... FROM STDIN fed with chunks of COPY text through a bounded queue.
+    None ends the stream, an exception put in the queue aborts the COPY with that error.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=LOAD_QUEUE_DEPTH)
+        self._buffer = ''
+        self._pos = 0
+        self._done = False
+
+    def read(self, size=-1):
+        while self._pos >= len(self._buffer):
+            if self._done:
+                return ''
+            chunk = self.queue.get()
+            if isinstance(chunk, BaseException):
+                raise chunk
+            if chunk is None:
+                self._done = True
+                return ''
+            self._buffer = chunk
+            self._pos = 0
+        if size is None or size < 0:
+            end = len(self._buffer)
+        else:
+            end = self._pos + size
+        data = self._buffer[self._pos:end]
+        self._pos += len(data)
+        return data
+
+
+def _copy_from_queue(connection_params, table_name, reader):
+    """
+    COPY everything fed to reader into table_name over its own connection and commit.
+    """
+    with pooledconnection(**connection_params) as con:
+        cur = con.cursor()
+        try:
+            with phase('loadandpartition.copy_part'):
+                cur.copy_expert(f"COPY {table_name} (userid, movieid, rating) FROM STDIN", reader,
+                                size=_RatingsFileReader.CHUNK_SIZE)
+            con.commit()
+        finally:
+            cur.close()
+
+
+def _feed(stream, chunk):
+    """
+    Queue a chunk for a (reader, future) stream, raising the error of the stream if it failed
+    instead of waiting on its full queue forever.
+    """
+    reader, future = stream
+    while True:
+        try:
+            reader.queue.put(chunk, timeout=0.1)
+            return
+        except queue.Full:
+            if future.done():
+                future.result()
+                return
+
+
+def _parse_lines(lines, firstline=1):
+    """
+    COPY text rows and ratings of the 'userid::movieid::rating::timestamp' lines, the first of
+    them being line firstline of the file. Blank lines are skipped, any other line without three
+    fields raises a ValueError.
+    """
+    rows = []
+    ratings = []
+    for k, line in enumerate(lines):
+        fields = line.split('::')
+        if len(fields) >= 3:
+            rating = fields[2].strip()
+            rows.append(f"{fields[0]}\t{fields[1]}\t{rating}\n")
+            ratings.append(float(rating))
+        elif line.strip():
+            raise ValueError(f"Malformed ratings line {firstline + k}: {line.rstrip()!r}")
+    return rows, ratings
+
+
+def _stream_partitions(ratingsfilepath, scheme, numberofpartitions, bounds, main_table, target_names,
+                       connection_params):
+    """
+    Read the ratings file once and COPY it into main_table (unless None) and into target_names at
+    the same time, one pooled connection per table. Every chunk of lines is parsed and routed here,
+    with the same rules as rangepartition (bounds) or roundrobinpartition (file order), and handed
+    to the COPY streams through bounded queues. Returns the number of rows read.
+    """
+    tables = ([main_table] if main_table else []) + list(target_names)
+    readers = [_QueueReader() for _ in tables]
+    total_rows = 0
+    parse_ns = 0
+    with ThreadPoolExecutor(max_workers=len(tables)) as pool:
+        streams = [(reader, pool.submit(_copy_from_queue, connection_params, table_name, reader))
+                   for table_name, reader in zip(tables, readers)]
+        partition_streams = streams[1:] if main_table else streams
+        try:
+            with open(ratingsfilepath, 'r') as file:
+                lineno = 1
+                while True:
+                    lines = file.readlines(_RatingsFileReader.CHUNK_SIZE)
+                    if not lines:
+                        break
+                    start = time.perf_counter_ns()
+                    rows, ratings = _parse_lines(lines, lineno)
+                    lineno += len(lines)
+                    if scheme == 'range':
+                        # Rows outside the boundaries stay out of every partition, as in rangepartition
+                        kept = [k for k, rating in enumerate(ratings)
+                                if bounds[0] <= rating <= bounds[-1]
+                                or bounds[0] <= routing.as_real(rating) <= bounds[-1]]
+                        routed = rows if len(kept) == len(rows) else [rows[k] for k in kept]
+                        ratings = ratings if len(kept) == len(rows) else [ratings[k] for k in kept]
+                        groups = routing.group_rows(routed, routing.range_partition_ids(ratings, bounds))
+                    else:
+                        groups = routing.group_rows(rows, routing.roundrobin_partition_ids(total_rows + 1, len(rows),
+                                                                                          numberofpartitions))
+                    parse_ns += time.perf_counter_ns() - start
+
+                    if main_table:
+                        _feed(streams[0], ''.join(rows))
+                    for index, group in groups.items():
+                        _feed(partition_streams[index], ''.join(group))
+                    total_rows += len(rows)
+            for stream in streams:
+                _feed(stream, None)
+        except BaseException as e:
+            # Abort every COPY still running, their connections roll back
+            for stream in streams:
+                try:
+                    _feed(stream, e)
+                except Exception:
+                    pass
+            raise
+        for _, future in streams:
+            future.result()
+    record('loadandpartition.parse', parse_ns, total_rows)
+    return total_rows
+
+
+@timed('loadandpartition')
+def loadandpartition(ratingstablename, ratingsfilepath, scheme, numberofpartitions, openconnection, materialize=True,
+                     indexes=False, durability='logged'):
+    """
+    Load the ratings file straight into range or round robin partitions, reading it only once.
+
+    The result is the same as loadratings followed by rangepartition (equal-width boundaries) or
+    roundrobinpartition, but the rows are routed on the client while the file is read, so the
+    dataset is not written into ratingstablename first and scanned back from there. The ratings
+    table and every partition are filled by their own COPY stream in parallel, into UNLOGGED
+    staging tables that replace the live tables in one transaction once every stream is done.
+
+    Args:
+        ratingstablename (str): Name of the main ratings table
+        ratingsfilepath (str): Path of the ratings file
+        scheme (str): 'range' or 'roundrobin'
+        numberofpartitions (int): Number of partitions to create
+        openconnection: PostgreSQL connection object
+        materialize (bool): Also load the rows into ratingstablename. Without it the table is
+            dropped and only the partitions hold the data, so the insert functions and
+            repartition cannot be used until the table is loaded again
+        indexes (bool): Index, ANALYZE and zone map the partitions before they are swapped in
+        durability (str): 'logged', 'unlogged' or 'deferred', see DURABILITY_MODES
+
+    Returns:
+        The number of rows read from the file
+    """
+    if scheme not in ('range', 'roundrobin'):
+        raise ValueError(f"Unknown partitioning scheme: {scheme}")
+    _check_durability(durability, openconnection)
+    streams = numberofpartitions + (1 if materialize else 0)
+    if streams > POOL_MAX_CONNECTIONS:
+        raise ValueError(f"Loading {streams} tables at once needs more than {POOL_MAX_CONNECTIONS} pooled connections")
+
+    # Ensure database exists before proceeding (checked once per process)
+    create_db(openconnection.info.dbname)
+
+    prefix = 'range_part' if scheme == 'range' else 'rrobin_part'
+    table_names = [prefix + str(i) for i in range(numberofpartitions)]
+    shadow_names = [table_name + SHADOW_SUFFIX for table_name in table_names]
+    staging_table = f"{ratingstablename}_load" if materialize else None
+    built_names = ([staging_table] if materialize else []) + shadow_names
+    bounds = _range_bounds(numberofpartitions) if scheme == 'range' else None
+
+    cur = openconnection.cursor()
+    prepared = False
+
+    try:
+        previous_placement = get_partition_info(prefix, openconnection)['placement']
+
+        # The staging tables have to be committed so the stream connections can see them
+        with phase('loadandpartition.prepare'):
+            _create_meta_table(cur)
+            for table_name in built_names:
+                cur.execute(f"DROP TABLE IF EXISTS {table_name};")
+                cur.execute(f"""
+                CREATE UNLOGGED TABLE {table_name} (
+                    userid INTEGER,
+                    movieid INTEGER,
+                    rating REAL
+                );
+                """)
+            openconnection.commit()
+            prepared = True
+
+        with phase('loadandpartition.stream') as stream_phase:
+            total_rows = _stream_partitions(ratingsfilepath, scheme, numberofpartitions, bounds, staging_table,
+                                            shadow_names, connection_parameters(openconnection))
+            stream_phase.rows = total_rows
+
+        _start_build(cur, durability)
+        if durability != 'unlogged':
+            with phase('loadandpartition.set_logged'):
+                for table_name in built_names:
+                    cur.execute(f"ALTER TABLE {table_name} SET LOGGED;")
+
+        if indexes:
+            with phase('loadandpartition.index'):
+                _index_partitions(cur, shadow_names)
+                _refresh_zonemap(cur, prefix + SHADOW_SUFFIX, shadow_names)
+
+        with phase('loadandpartition.swap'):
+            # Native partitions of the old table go with it
+            _forget_native_partitions(cur, ratingstablename)
+            cur.execute(f"DROP TABLE IF EXISTS {ratingstablename};")
+            if materialize:
+                cur.execute(f"ALTER TABLE {staging_table} RENAME TO {ratingstablename};")
+            _register_partitions(cur, prefix, ratingstablename, scheme, table_names, bounds,
+                                 'rating' if scheme == 'range' else None, 'equal' if scheme == 'range' else None)
+            _swap_in_shadow(cur, prefix, table_names)
+
+            # Every row of the file was numbered, so the round robin routing state is the row count
+            _reset_row_counter(cur, ratingstablename)
+            cur.execute(f"""
+            INSERT INTO {RROBIN_META_TABLE} (ratingstablename, row_count, numberofpartitions)
+            VALUES (%s, %s, %s);
+            """, (ratingstablename, total_rows, numberofpartitions))
+
+        identities = _local_identities(cur, table_names, previous_placement)
+
+        with phase('loadandpartition.commit'):
+            openconnection.commit()
+        # Native partitions and routing triggers were dropped along with the old table
+        invalidate_partition_cache()
+        _drop_stale_partitions(previous_placement, {}, identities)
+        return total_rows
+
+    except Exception as e:
+        openconnection.rollback()
+        if prepared:
+            for table_name in built_names:
+                cur.execute(f"DROP TABLE IF EXISTS {table_name};")
+            openconnection.commit()
+        print(f"Loading into partitions failed: {str(e)}")
+        raise
+
+    finally:
+        cur.close()
+
+
+@timed('roundrobininsert')
+def roundrobininsert(ratingstablename, userid, itemid, rating, openconnection):
+    cur = openconnection.cursor()
+    RROBIN_TABLE_PREFIX = 'rrobin_part'
 
-    # Connect to the default database
-    con = getopenconnection(dbname='postgres')
-    con.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-    cur = con.cursor()
+    try:
+        info = get_partition_info(RROBIN_TABLE_PREFIX, openconnection)
+        if info['trigger']:
+            # The routing trigger counts the row and puts it in its partition on the server
+            with phase('roundrobininsert.insert_main'):
+                cur.execute(f"INSERT INTO {ratingstablename} (userid, movieid, rating) VALUES (%s, %s, %s);",
+                            (userid, itemid, rating))
+            with phase('roundrobininsert.commit'):
+                openconnection.commit()
+            return
+
+        # Step 1: Insert into main table and advance the row counter in the same statement
+        insert_main_query = f"""
+        WITH ins AS (
+            INSERT INTO {ratingstablename} (userid, movieid, rating) 
+            VALUES (%s, %s, %s)
+        )
+        UPDATE {RROBIN_META_TABLE} SET row_count = row_count + 1
+        WHERE ratingstablename = %s
+        RETURNING row_count, numberofpartitions;
+        """
+        with phase('roundrobininsert.insert_main'):
+            cur.execute(insert_main_query, (userid, itemid, rating, ratingstablename))
+            state = cur.fetchone()
+
+        with phase('roundrobininsert.route'):
+            if state is not None:
+                # Step 2: The counter equals the number of rows in the main table after insertion
+                total_rows, numberofpartitions = state
+            else:
+                # Step 2: No routing state yet, count the rows and partitions once and store them
+                total_rows, numberofpartitions = _seed_row_counter(cur, ratingstablename, RROBIN_TABLE_PREFIX,
+                                                                   openconnection)
 
-    # Check if an existing database with the same name exists
-    cur.execute('SELECT COUNT(*) FROM pg_catalog.pg_database WHERE datname=\'%s\'' % (dbname,))
-    count = cur.fetchone()[0]
-    if count == 0:
-        cur.execute('CREATE DATABASE %s' % (dbname,))  # Create the database
-    else:
-        print('A database named {0} already exists'.format(dbname))
+            # Step 3: Calculate which partition this new row should go to
+            # Since we use 0-based indexing and round robin distribution
+            partition_index = (total_rows - 1) % numberofpartitions
+            partition_table_name = RROBIN_TABLE_PREFIX + str(partition_index)
 
-    # Clean up
-    cur.close()
-    con.close()
+        # Step 4: Insert into the appropriate partition table
+        insert_partition_query = f"""
+        INSERT INTO {partition_table_name} (userid, movieid, rating) 
+        VALUES (%s, %s, %s);
+        """
+        node = _partition_node(info, partition_table_name)
+        with phase('roundrobininsert.insert_partition'):
+            if node is not None:
+                _insert_on_node(node, partition_table_name, [(userid, itemid, rating)])
+            else:
+                cur.execute(insert_partition_query, (userid, itemid, rating))
+            _widen_zonemap(cur, info, partition_table_name, [(userid, itemid, rating)])
 
-    end_time = time.time()
-    execution_time = end_time - start_time
-    print(f"create_db completed in {execution_time:.4f} seconds")
+        # Commit the transaction
+        with phase('roundrobininsert.commit'):
+            openconnection.commit()
 
+    except Exception as e:
+        # Rollback in case of error
+        openconnection.rollback()
+        print(f"Error inserting record: {str(e)}")
+        raise e
 
-def count_partitions(prefix, openconnection):
-    con = openconnection
-    cur = con.cursor()
-    cur.execute("select count(*) from pg_stat_user_tables where relname like " + "'" + prefix + "%';")
-    count = cur.fetchone()[0]
-    cur.close()
-    return count
+    finally:
+        # Close cursor (but not connection as per requirement)
+        cur.close()
 
 
-def loadratings(ratingstablename, ratingsfilepath, openconnection):
-    start_time = time.time()
+def _partition_bounds(info):
+    """
+    Boundaries of registered range partitions, or the equal-width ones for unregistered partitions.
+    """
+    return info['boundaries'] or _range_bounds(info['numberofpartitions'])
 
-    # Ensure database exists before proceeding
-    create_db('dds_assign1')  # Create database if it doesn't exist
 
-    # Get cursor from the connection
+@timed('rangeinsert')
+def rangeinsert(ratingstablename, userid, itemid, rating, openconnection):
     cur = openconnection.cursor()
+    RANGE_TABLE_PREFIX = "range_part"
+
+    if rating > 5 or rating < 0:
+        print(f"Rating value is invalid: {rating}")
+        return "Rating value is invalid"
 
     try:
-        # Step 1: Drop table if exists and create new one with temporary columns for parsing
-        cur.execute(f"DROP TABLE IF EXISTS {ratingstablename};")
+        # Step1: Insert main table, keeping the round robin row counter in step
+        insert_table_query = f"""
+                {_bump_row_counter_query(ratingstablename, openconnection)}
+                INSERT INTO {ratingstablename} (userid, movieid, rating) 
+                VALUES (%s, %s, %s);
+            """
+        with phase('rangeinsert.insert_main'):
+            cur.execute(insert_table_query, (userid, itemid, rating))
 
-        # Build table structure with parsing columns
-        table_schema = f"""
-        CREATE TABLE {ratingstablename} (
-            userid INTEGER,
-            extra1 CHAR,
-            movieid INTEGER, 
-            extra2 CHAR,
-            rating REAL,
-            extra3 CHAR,
-            timestamp BIGINT
-        );
-        """
-        cur.execute(table_schema)
-
-        # Step 2: Use COPY FROM for fast bulk loading
-        with open(ratingsfilepath, 'r') as file:
-            cur.copy_from(file, ratingstablename, sep=':')
-
-        # Step 3: Remove unnecessary columns
-        cleanup_query = f"""
-        ALTER TABLE {ratingstablename} 
-        DROP COLUMN extra1,
-        DROP COLUMN extra2,
-        DROP COLUMN extra3,
-        DROP COLUMN timestamp;
-        """
-        cur.execute(cleanup_query)
+        with phase('rangeinsert.route'):
+            # Step 2: Look up the partition boundaries
+            info = get_partition_info(RANGE_TABLE_PREFIX, openconnection)
+            bounds = _partition_bounds(info)
 
-        # Get row count for reporting
-        cur.execute(f"SELECT COUNT(*) FROM {ratingstablename};")
-        row_count = cur.fetchone()[0]
+            # Step 3: Define partition that will insert
+            index = routing.range_partition_id(rating, bounds)
 
-        # Commit the transaction
-        openconnection.commit()
-        print(f"Data loading successful: {row_count} records imported to {ratingstablename}")
+            table_name = RANGE_TABLE_PREFIX + str(index)
+
+        # Step 4: Insert data into partition, unless the main table is natively partitioned or has
+        # a routing trigger and Postgres already routed the row there
+        if info['scheme'] != 'range_native' and not info['trigger']:
+            insert_query = (f"""
+                INSERT INTO {table_name} (userid, movieid, rating) 
+                VALUES (%s, %s, %s)
+                """)
+            node = _partition_node(info, table_name)
+            with phase('rangeinsert.insert_partition'):
+                if node is not None:
+                    _insert_on_node(node, table_name, [(userid, itemid, rating)])
+                else:
+                    cur.execute(insert_query, (userid, itemid, rating))
+        # Natively routed rows land in the partition as well, so its zone map is widened either way
+        _widen_zonemap(cur, info, table_name, [(userid, itemid, rating)])
+
+        with phase('rangeinsert.commit'):
+            openconnection.commit()
 
     except Exception as e:
         # Rollback in case of error
         openconnection.rollback()
-        print(f"Data loading failed: {str(e)}")
+        print(f"Error inserting record: {str(e)}")
         raise e
 
     finally:
         # Close cursor (but not connection as per requirement)
         cur.close()
 
-    end_time = time.time()
-    total_time = end_time - start_time
-    print(f"Operation completed in {total_time:.4f} seconds")
 
-def rangepartition(ratingstablename, numberofpartitions, openconnection):
+def _insert_rows(cur, table_name, rows):
+    # One COPY per table is cheaper than multi-row INSERTs for any batch of more than a few rows
+    cur.copy_expert(f"COPY {table_name} (userid, movieid, rating) FROM STDIN", routing.copy_buffer(rows))
+
+
+@timed('rangeinsertbatch')
+def rangeinsertbatch(ratingstablename, rows, openconnection):
     """
-    Function to create range partitions for a ratings table based on the Rating value.
+    Insert many (userid, movieid, rating) tuples at once, each row going to the same range partition
+    rangeinsert would pick. All rows are written in one transaction, grouped per partition.
     """
-    start_time = time.time()  
-    RANGE_TABLE_PREFIX = 'range_part'
+    RANGE_TABLE_PREFIX = "range_part"
+
+    rows = list(rows)
+    if not rows:
+        return
+    for row in rows:
+        if row[2] > 5 or row[2] < 0:
+            print(f"Rating value is invalid: {row[2]}")
+            return "Rating value is invalid"
+
     cur = openconnection.cursor()
 
     try:
-        for i in range(numberofpartitions):
-            cur.execute(f"DROP TABLE IF EXISTS {RANGE_TABLE_PREFIX}{i};")
+        # Step 1: Insert main table, keeping the round robin row counter in step
+        with phase('rangeinsertbatch.insert_main', rows=len(rows)):
+            _insert_rows(cur, ratingstablename, rows)
+            if not _counter_kept_by_trigger(openconnection):
+                cur.execute(f"UPDATE {RROBIN_META_TABLE} SET row_count = row_count + %s WHERE ratingstablename = %s;",
+                            (len(rows), ratingstablename))
+
+        # Step 2: Route every row on the client and group them per partition
+        with phase('rangeinsertbatch.route', rows=len(rows)):
+            info = get_partition_info(RANGE_TABLE_PREFIX, openconnection)
+            bounds = _partition_bounds(info)
+            groups = routing.group_rows(rows, routing.range_partition_ids([row[2] for row in rows], bounds))
+
+        # Step 3: Write each group with a single COPY (a natively partitioned main
+        # table or a routing trigger has already routed the rows itself)
+        for index, group in groups.items():
+            table_name = RANGE_TABLE_PREFIX + str(index)
+            if info['scheme'] != 'range_native' and not info['trigger']:
+                node = _partition_node(info, table_name)
+                with phase('rangeinsertbatch.insert_partition', rows=len(group)):
+                    if node is not None:
+                        _insert_on_node(node, table_name, group)
+                    else:
+                        _insert_rows(cur, table_name, group)
+            _widen_zonemap(cur, info, table_name, group)
+
+        with phase('rangeinsertbatch.commit'):
+            openconnection.commit()
+
+    except Exception as e:
+        # Rollback in case of error
+        openconnection.rollback()
+        print(f"Error inserting records: {str(e)}")
+        raise e
+
+    finally:
+        cur.close()
+
 
-        interval = 5.0 / numberofpartitions
+@timed('roundrobininsertbatch')
+def roundrobininsertbatch(ratingstablename, rows, openconnection):
+    """
+    Insert many (userid, movieid, rating) tuples at once. Rows are numbered in the given order and
+    placed exactly as the same sequence of roundrobininsert calls would place them.
+    """
+    RROBIN_TABLE_PREFIX = 'rrobin_part'
+
+    rows = list(rows)
+    if not rows:
+        return
 
-        for i in range(numberofpartitions):
-            table_name = f"{RANGE_TABLE_PREFIX}{i}"
+    cur = openconnection.cursor()
+
+    try:
+        info = get_partition_info(RROBIN_TABLE_PREFIX, openconnection)
+        if info['trigger']:
+            # The routing trigger numbers the rows in COPY order and routes them on the server
+            with phase('roundrobininsertbatch.insert_main', rows=len(rows)):
+                _insert_rows(cur, ratingstablename, rows)
+            with phase('roundrobininsertbatch.commit'):
+                openconnection.commit()
+            return
+
+        # Step 1: Insert into main table and reserve a block of row numbers
+        with phase('roundrobininsertbatch.insert_main', rows=len(rows)):
+            _insert_rows(cur, ratingstablename, rows)
             cur.execute(f"""
-                CREATE TABLE IF NOT EXISTS {table_name} (
-                    userid INTEGER,
-                    movieid INTEGER,
-                    rating REAL
-                );
-            """)
-            
-            if i == 0:
-                cur.execute(f"""
-                    INSERT INTO {table_name}
-                    SELECT * FROM {ratingstablename}
-                    WHERE rating >= {i * interval} AND rating <= {(i + 1) * interval};
-                """)
+            UPDATE {RROBIN_META_TABLE} SET row_count = row_count + %s
+            WHERE ratingstablename = %s
+            RETURNING row_count, numberofpartitions;
+            """, (len(rows), ratingstablename))
+            state = cur.fetchone()
+            if state is not None:
+                total_rows, numberofpartitions = state
             else:
-                cur.execute(f"""
-                    INSERT INTO {table_name}
-                    SELECT * FROM {ratingstablename}
-                    WHERE rating > {i * interval} AND rating <= {(i + 1) * interval};
-                """)
+                total_rows, numberofpartitions = _seed_row_counter(cur, ratingstablename, RROBIN_TABLE_PREFIX,
+                                                                   openconnection)
+
+        # Step 2: Row j of the batch is row number first_row + j of the main table
+        with phase('roundrobininsertbatch.route', rows=len(rows)):
+            first_row = total_rows - len(rows) + 1
+            groups = routing.group_rows(rows, routing.roundrobin_partition_ids(first_row, len(rows),
+                                                                               numberofpartitions))
+
+        # Step 3: Write each group with a single COPY
+        for index, group in groups.items():
+            table_name = RROBIN_TABLE_PREFIX + str(index)
+            node = _partition_node(info, table_name)
+            with phase('roundrobininsertbatch.insert_partition', rows=len(group)):
+                if node is not None:
+                    _insert_on_node(node, table_name, group)
+                else:
+                    _insert_rows(cur, table_name, group)
+            _widen_zonemap(cur, info, table_name, group)
+
+        with phase('roundrobininsertbatch.commit'):
+            openconnection.commit()
+
+    except Exception as e:
+        # Rollback in case of error
+        openconnection.rollback()
+        print(f"Error inserting records: {str(e)}")
+        raise e
+
+    finally:
+        cur.close()
 
+
+# Body of the routing trigger functions, with TG_ARGV[0] the partition prefix and TG_ARGV[1] the
+# ratings table. Both end by writing NEW into the partition named by target and widening its zone map
+_ROUTE_ROW_TAIL = f"""
+    EXECUTE format('INSERT INTO %I (userid, movieid, rating) VALUES ($1, $2, $3)', target)
+        USING NEW.userid, NEW.movieid, NEW.rating;
+    UPDATE {PARTITION_ZONEMAP_TABLE} SET rowcount = rowcount + 1,
+        minuserid = LEAST(minuserid, NEW.userid), maxuserid = GREATEST(maxuserid, NEW.userid),
+        minmovieid = LEAST(minmovieid, NEW.movieid), maxmovieid = GREATEST(maxmovieid, NEW.movieid),
+        minrating = LEAST(minrating, NEW.rating), maxrating = GREATEST(maxrating, NEW.rating)
+    WHERE tablename = target;
+    RETURN NULL;
+"""
+
+ROUTING_TRIGGER_FUNCTIONS = {
+    # Same rule as rangeinsert: the first partition whose upper bound is not below the stored
+    # rating, read from the registry so a repartitioned layout is followed right away
+    'range': ('range_route_row', f"""
+DECLARE
+    bounds DOUBLE PRECISION[];
+    n INTEGER;
+    target TEXT;
+BEGIN
+    SELECT boundaries, numberofpartitions INTO bounds, n FROM {PARTITION_REGISTRY_TABLE} WHERE prefix = TG_ARGV[0];
+    IF NEW.rating IS NULL OR NEW.rating < bounds[1] OR NEW.rating > bounds[n + 1] THEN
+        RETURN NULL;
+    END IF;
+    FOR i IN 1..n LOOP
+        IF NEW.rating <= bounds[i + 1] THEN
+            target := TG_ARGV[0] || (i - 1);
+            EXIT;
+        END IF;
+    END LOOP;
+{_ROUTE_ROW_TAIL}END;
+"""),
+    # Same rule as roundrobininsert: row number r goes to partition (r - 1) % n, the counter being
+    # advanced here for every row inserted into the ratings table
+    'roundrobin': ('rrobin_route_row', f"""
+DECLARE
+    total BIGINT;
+    n INTEGER;
+    target TEXT;
+BEGIN
+    UPDATE {RROBIN_META_TABLE} SET row_count = row_count + 1 WHERE ratingstablename = TG_ARGV[1]
+    RETURNING row_count, numberofpartitions INTO total, n;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'No round robin routing state for %', TG_ARGV[1];
+    END IF;
+    target := TG_ARGV[0] || ((total - 1) % n);
+{_ROUTE_ROW_TAIL}END;
+"""),
+}
+
+
+def _routing_trigger_name(prefix):
+    return f"{prefix}_route"
+
+
+def _has_routing_trigger(cur, ratingstablename, prefix):
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = %s AND tgrelid = to_regclass(%s));",
+                (_routing_trigger_name(prefix), ratingstablename))
+    return cur.fetchone()[0]
+
+
+def _drop_routing_trigger(cur, prefix):
+    """
+    Drop the routing trigger of the prefix from whatever table it is on, in the caller's transaction.
+    """
+    cur.execute("SELECT tgrelid::regclass::TEXT FROM pg_trigger WHERE tgname = %s;", (_routing_trigger_name(prefix),))
+    for (table_name,) in cur.fetchall():
+        cur.execute(f"DROP TRIGGER IF EXISTS {_routing_trigger_name(prefix)} ON {table_name};")
+
+
+def _saved_routing_triggers(cur, ratingstablename):
+    """
+    (prefix, function name) of every routing trigger on ratingstablename, read before the table
+    is dropped and recreated so _restore_routing_triggers can put them back.
+    """
+    suffix = _routing_trigger_name('')
+    cur.execute("SELECT tgname, tgfoid::regproc::TEXT FROM pg_trigger WHERE tgrelid = to_regclass(%s);",
+                (ratingstablename,))
+    return [(name[:-len(suffix)], function_name) for name, function_name in cur.fetchall() if name.endswith(suffix)]
+
+
+def _restore_routing_triggers(cur, ratingstablename, triggers):
+    for prefix, function_name in triggers:
+        cur.execute(f"""
+        CREATE TRIGGER {_routing_trigger_name(prefix)} AFTER INSERT ON {ratingstablename}
+        FOR EACH ROW EXECUTE PROCEDURE {function_name}('{prefix}', '{ratingstablename}');
+        """)
+
+
+def _counter_kept_by_trigger(openconnection):
+    # The round robin routing trigger advances the row counter for every insert into the ratings table
+    return get_partition_info('rrobin_part', openconnection)['trigger']
+
+
+def installroutingtrigger(prefix, openconnection):
+    """
+    Route the rows inserted into the ratings table on the server: an AFTER INSERT trigger puts
+    every new row into its partition with the same rules as rangeinsert or roundrobininsert, so a
+    single INSERT (or COPY) into the ratings table is all an insert takes. The insert functions
+    notice the trigger and leave the routing (and, for round robin, the row counter) to it.
+
+    Every row inserted into the ratings table is routed, whichever function inserts it. The
+    cached zone maps of the prefix are not used for pruning while the trigger is installed, as
+    only the stored ones are widened on the server. The trigger is dropped with the ratings table
+    and when the partitions are placed on other nodes.
+
+    Args:
+        prefix (str): 'range_part' or 'rrobin_part', the prefix of registered local partitions
+        openconnection: PostgreSQL connection object
+    """
+    info = get_partition_info(prefix, openconnection)
+    if info['scheme'] not in ROUTING_TRIGGER_FUNCTIONS:
+        raise ValueError(f"No routing trigger for the partitions of {prefix} (scheme {info['scheme']})")
+    if info['placement']:
+        raise ValueError(f"The partitions of {prefix} live on other nodes, a trigger cannot reach them")
+    ratingstablename = info['ratingstablename']
+    function_name, body = ROUTING_TRIGGER_FUNCTIONS[info['scheme']]
+
+    cur = openconnection.cursor()
+
+    try:
+        # The trigger widens the stored zone maps, so the table has to exist even without them
+        _create_zonemap_table(cur)
+        if info['scheme'] == 'roundrobin':
+            _create_meta_table(cur)
+            cur.execute(f"SELECT 1 FROM {RROBIN_META_TABLE} WHERE ratingstablename = %s;", (ratingstablename,))
+            if cur.fetchone() is None:
+                _seed_row_counter(cur, ratingstablename, prefix, openconnection)
+
+        cur.execute(f"CREATE OR REPLACE FUNCTION {function_name}() RETURNS trigger AS $route${body}$route$ LANGUAGE plpgsql;")
+        trigger_name = _routing_trigger_name(prefix)
+        cur.execute(f"DROP TRIGGER IF EXISTS {trigger_name} ON {ratingstablename};")
+        cur.execute(f"""
+        CREATE TRIGGER {trigger_name} AFTER INSERT ON {ratingstablename}
+        FOR EACH ROW EXECUTE PROCEDURE {function_name}('{prefix}', '{ratingstablename}');
+        """)
         openconnection.commit()
+        invalidate_partition_cache(prefix)
+
+    except Exception as e:
+        openconnection.rollback()
+        print(f"Error installing routing trigger: {str(e)}")
+        raise
+
+    finally:
+        cur.close()
+
+
+def droproutingtrigger(prefix, openconnection):
+    """
+    Go back to routing the inserts of the prefix on the client.
+    """
+    cur = openconnection.cursor()
 
-        # Kết thúc đo thời gian
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        print(f"Successfully created {numberofpartitions} range partitions in {elapsed_time:.4f} seconds.")
+    try:
+        _drop_routing_trigger(cur, prefix)
+        openconnection.commit()
+        invalidate_partition_cache(prefix)
 
     except Exception as e:
         openconnection.rollback()
-        print(f"Error in rangepartition: {str(e)}")
+        print(f"Error dropping routing trigger: {str(e)}")
         raise
 
     finally:
         cur.close()
 
-def roundrobinpartition(ratingstablename, numberofpartitions, openconnection):
+
+def _hash_index(key, numberofpartitions):
     """
-    Function to create partitions of main table using round robin approach.
+    Index of the hash partition owning key. Matches the ((key % n) + n) % n expression used on
+    the server, which keeps negative keys in [0, n) like Python's modulo.
+    """
+    return key % numberofpartitions
+
+
+@timed('hashpartition')
+def hashpartition(ratingstablename, numberofpartitions, openconnection, column='userid', indexes=False):
+    """
+    Function to create hash partitions of the main table on userid or movieid, so that all the
+    ratings of one user (or movie) end up in a single partition.
 
     Args:
         ratingstablename (str): Name of the main ratings table
         numberofpartitions (int): Number of partitions to create
         openconnection: PostgreSQL connection object
+        column (str): Partitioning key, 'userid' or 'movieid'
+        indexes (bool): Index, ANALYZE and zone map the partitions once they are filled, as in rangepartition
     """
-    start_time = time.time()  
+    if column not in ('userid', 'movieid'):
+        raise ValueError(f"Hash partitioning key must be userid or movieid, not {column}")
+
+    HASH_TABLE_PREFIX = 'hash_part'
     cur = openconnection.cursor()
-    RROBIN_TABLE_PREFIX = 'rrobin_part'
 
     try:
-        # Step 1: Create partition tables
-        for i in range(numberofpartitions):
-            table_name = RROBIN_TABLE_PREFIX + str(i)
-            create_table_query = f"""
-            CREATE TABLE IF NOT EXISTS {table_name} (
-                userid INTEGER,
-                movieid INTEGER,
-                rating REAL
-            );
-            """
-            cur.execute(create_table_query)
-
-            # Clear existing data if any
-            cur.execute(f"DELETE FROM {table_name};")
-
-        # Step 2: Distribute data using round robin approach
-        # Use ROW_NUMBER() to assign sequential numbers to rows
-        # Then use modulo operation to distribute to partitions
-        for i in range(numberofpartitions):
-            table_name = RROBIN_TABLE_PREFIX + str(i)
-
-            insert_query = f"""
-            INSERT INTO {table_name} (userid, movieid, rating)
-            SELECT userid, movieid, rating 
-            FROM (
-                SELECT userid, movieid, rating, 
-                       ROW_NUMBER() OVER() as row_num
+        # hashinsert keeps the round robin row counter up to date, so the table has to exist
+        _create_meta_table(cur)
+
+        # Step 1: Create empty partition tables
+        table_names = [HASH_TABLE_PREFIX + str(i) for i in range(numberofpartitions)]
+        with phase('hashpartition.prepare'):
+            for table_name in table_names:
+                cur.execute(f"DROP TABLE IF EXISTS {table_name};")
+                cur.execute(f"""
+                CREATE TABLE {table_name} (
+                    userid INTEGER,
+                    movieid INTEGER,
+                    rating REAL
+                );
+                """)
+
+        # Step 2: Route every row to the partition of its key in a single pass
+        with phase('hashpartition.fill') as fill_phase:
+            fill_phase.rows = sum(_fan_out_copy(cur, f"""
+                SELECT (({column} % {numberofpartitions}) + {numberofpartitions}) % {numberofpartitions} AS part,
+                       userid, movieid, rating
                 FROM {ratingstablename}
-            ) as numbered_rows
-            WHERE (row_num - 1) % {numberofpartitions} = {i};
-            """
-            cur.execute(insert_query)
+                WHERE {column} IS NOT NULL
+            """, table_names))
 
-        # Commit the transaction
-        openconnection.commit()
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        print(f"Successfully created {numberofpartitions} round robin partitions in {elapsed_time:.4f} seconds.")
+        _register_partitions(cur, HASH_TABLE_PREFIX, ratingstablename, 'hash', table_names, partitionkey=column)
+
+        if indexes:
+            with phase('hashpartition.index'):
+                _index_partitions(cur, table_names)
+                _refresh_zonemap(cur, HASH_TABLE_PREFIX, table_names)
+
+        with phase('hashpartition.commit'):
+            openconnection.commit()
+        invalidate_partition_cache(HASH_TABLE_PREFIX)
 
     except Exception as e:
-        # Rollback in case of error
         openconnection.rollback()
-        print(f"Error creating round robin partitions: {str(e)}")
+        print(f"Error creating hash partitions: {str(e)}")
         raise e
 
     finally:
-        # Close cursor (but not connection as per requirement)
         cur.close()
 
-def roundrobininsert(ratingstablename, userid, itemid, rating, openconnection):
-    start_time = time.time()
 
+@timed('hashinsert')
+def hashinsert(ratingstablename, userid, itemid, rating, openconnection):
     cur = openconnection.cursor()
-    RROBIN_TABLE_PREFIX = 'rrobin_part'
+    HASH_TABLE_PREFIX = 'hash_part'
 
     try:
-        # Step 1: Insert into main table
-        insert_main_query = f"""
-        INSERT INTO {ratingstablename} (userid, movieid, rating) 
-        VALUES (%s, %s, %s);
-        """
-        cur.execute(insert_main_query, (userid, itemid, rating))
-
-        # Step 2: Get total number of rows in main table after insertion
-        cur.execute(f"SELECT COUNT(*) FROM {ratingstablename};")
-        total_rows = cur.fetchone()[0]
-
-        # Step 3: Count number of existing partitions
-        numberofpartitions = count_partitions(RROBIN_TABLE_PREFIX, openconnection)
-
-        # Step 4: Calculate which partition this new row should go to
-        # Since we use 0-based indexing and round robin distribution
-        partition_index = (total_rows - 1) % numberofpartitions
-        partition_table_name = RROBIN_TABLE_PREFIX + str(partition_index)
-
-        # Step 5: Insert into the appropriate partition table
-        insert_partition_query = f"""
-        INSERT INTO {partition_table_name} (userid, movieid, rating) 
-        VALUES (%s, %s, %s);
-        """
-        cur.execute(insert_partition_query, (userid, itemid, rating))
+        # Step 1: Insert main table, keeping the round robin row counter in step
+        with phase('hashinsert.insert_main'):
+            cur.execute(f"""
+            {_bump_row_counter_query(ratingstablename, openconnection)}
+            INSERT INTO {ratingstablename} (userid, movieid, rating) 
+            VALUES (%s, %s, %s);
+            """, (userid, itemid, rating))
+
+        # Step 2: Find the partition owning the key of the row
+        with phase('hashinsert.route'):
+            info = get_partition_info(HASH_TABLE_PREFIX, openconnection)
+            key = itemid if info['partitionkey'] == 'movieid' else userid
+            table_name = HASH_TABLE_PREFIX + str(_hash_index(key, info['numberofpartitions']))
+
+        # Step 3: Insert data into partition
+        with phase('hashinsert.insert_partition'):
+            cur.execute(f"""
+            INSERT INTO {table_name} (userid, movieid, rating) 
+            VALUES (%s, %s, %s);
+            """, (userid, itemid, rating))
+            _widen_zonemap(cur, info, table_name, [(userid, itemid, rating)])
 
-        # Commit the transaction
-        openconnection.commit()
-        print(f"Successfully inserted record into {ratingstablename} and {partition_table_name}")
+        with phase('hashinsert.commit'):
+            openconnection.commit()
 
     except Exception as e:
         # Rollback in case of error
@@ -262,65 +2390,375 @@ def roundrobininsert(ratingstablename, userid, itemid, rating, openconnection):
         raise e
 
     finally:
-        # Close cursor (but not connection as per requirement)
         cur.close()
 
-    end_time = time.time()
-    total_time = end_time - start_time
-    print(f"roundrobininsert completed in {total_time:.4f} seconds")
-
 
-def rangeinsert(ratingstablename, userid, itemid, rating, openconnection):
-    start_time = time.time()
+def hashlookup(key, openconnection):
+    """
+    All (userid, movieid, rating) rows whose partitioning key equals key, read from the single
+    hash partition that owns it instead of from every partition.
+    """
+    HASH_TABLE_PREFIX = 'hash_part'
+    info = get_partition_info(HASH_TABLE_PREFIX, openconnection)
+    column = info['partitionkey'] or 'userid'
+    table_name = HASH_TABLE_PREFIX + str(_hash_index(key, info['numberofpartitions']))
 
     cur = openconnection.cursor()
-    RANGE_TABLE_PREFIX = "range_part"
+    try:
+        cur.execute(f"SELECT userid, movieid, rating FROM {table_name} WHERE {column} = %s;", (key,))
+        return cur.fetchall()
+    finally:
+        cur.close()
 
-    if rating > 5 or rating < 0:
-        print(f"Rating value is invalid: {rating}")
-        return f"Rating value is invalid"
 
-    try:
-        # Step1: Insert main table
-        insert_table_query = f"""
-                INSERT INTO {ratingstablename} (userid, movieid, rating) 
-                VALUES (%s, %s, %s);
-            """
-        cur.execute(insert_table_query, (userid, itemid, rating))
+def _range_member_predicate(bounds, i):
+    """
+    WHERE condition selecting the rows that belong to range partition i.
+    """
+    if i == 0:
+        return f"rating >= {bounds[0]} AND rating <= {bounds[1]}"
+    return f"rating > {bounds[i]} AND rating <= {bounds[i + 1]}"
 
-        # Step 2: Count numbers of partitions
-        numbers = count_partitions(RANGE_TABLE_PREFIX, openconnection)
 
-        # Step 3: Calculate range value of each partition
-        delta = 5 / numbers  # max rating = 5
+def _move_rows(cur, source_table, target_table, condition=None, limit=None):
+    """
+    Move the rows of source_table matching condition (at most limit of them) into target_table in
+    one statement. Returns the number of rows moved.
+    """
+    if limit is not None:
+        condition = f"ctid IN (SELECT ctid FROM {source_table} LIMIT {int(limit)})"
+    where = f" WHERE {condition}" if condition else ""
+    cur.execute(f"""
+    WITH moved AS (
+        DELETE FROM {source_table}{where}
+        RETURNING userid, movieid, rating
+    )
+    INSERT INTO {target_table} (userid, movieid, rating)
+    SELECT userid, movieid, rating FROM moved;
+    """)
+    return cur.rowcount
+
+
+def repartition(ratingstablename, numberofpartitions, openconnection, prefix='range_part', boundaries=None):
+    """
+    Change the number of partitions of an existing partitioning, moving only the rows whose
+    partition changes instead of rebuilding every table.
 
-        # Step 4: Define partition that will insert
-        index = int(rating / delta)
-        if rating % delta == 0 and index != 0:
-            index -= 1
+    Range and hash partitions keep the rows that still belong to them and hand the others over
+    through a temporary staging table. Round robin partitions do not record the original row
+    numbers, so each partition keeps its rows up to its new round robin size and only the surplus
+    is moved to the partitions that are short. Native range partitions cannot be re-bounded in
+    place and are rebuilt as a whole.
 
-        table_name = RANGE_TABLE_PREFIX + str(index)
+    Args:
+        ratingstablename (str): Name of the main ratings table
+        numberofpartitions (int): New number of partitions
+        openconnection: PostgreSQL connection object
+        prefix (str): Partition table prefix of the partitioning to change
+        boundaries (str): For range partitions, 'equal' or 'quantile' boundaries as in rangepartition,
+            by default the kind the partitions were built with
 
-        # Step 5: Insert data into partition
-        insert_query = (f"""
-            INSERT INTO {table_name} (userid, movieid, rating) 
-            VALUES (%s, %s, %s)
+    Partitions that were built with indexes keep them: new partitions are indexed as well and
+    the zone maps of all partitions are recomputed after the moves.
+
+    Returns:
+        dict with the number of rows moved and the elapsed time in seconds
+    """
+    start_time = time.perf_counter()
+    STAGING_TABLE = 'repartition_moved'
+
+    info = get_partition_info(prefix, openconnection)
+    scheme = info['scheme']
+    if scheme is None:
+        raise ValueError(f"No registered partitions with prefix {prefix}")
+    if info['placement']:
+        raise ValueError(f"Partitions with prefix {prefix} are placed on other nodes, rebuild them with the new count instead")
+    indexes = info['zonemap'] is not None
+    if boundaries is None:
+        boundaries = info['boundarymode'] or 'equal'
+
+    if scheme == 'range_native':
+        rangepartition(ratingstablename, numberofpartitions, openconnection, backend='native',
+                       boundaries=boundaries, indexes=indexes)
+        cur = openconnection.cursor()
+        cur.execute(f"SELECT COUNT(*) FROM {ratingstablename};")
+        moved = cur.fetchone()[0]
+        cur.close()
+        elapsed_time = time.perf_counter() - start_time
+        record('repartition', int(elapsed_time * 1e9), moved)
+        return dict(moved=moved, elapsed=elapsed_time)
+
+    old_tables = info['tablenames']
+    new_tables = [prefix + str(i) for i in range(numberofpartitions)]
+    column = info['partitionkey']
+    cur = openconnection.cursor()
+
+    try:
+        bounds = None
+        if scheme == 'range':
+            with phase('repartition.bounds'):
+                bounds = _compute_range_bounds(cur, ratingstablename, numberofpartitions, boundaries)
+
+        # Step 1: Create the partitions that do not exist yet (UNLOGGED like the existing ones if
+        # they were built that way) and a staging table for moved rows
+        cur.execute("SELECT relpersistence = 'u' FROM pg_class WHERE oid = to_regclass(%s);", (old_tables[0],))
+        row = cur.fetchone()
+        unlogged = 'UNLOGGED ' if row is not None and row[0] else ''
+        for table_name in new_tables[len(old_tables):]:
+            cur.execute(f"""
+            CREATE {unlogged}TABLE IF NOT EXISTS {table_name} (
+                userid INTEGER,
+                movieid INTEGER,
+                rating REAL
+            );
             """)
-        cur.execute(insert_query, (userid, itemid, rating))
+        cur.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE};")
+        cur.execute(f"CREATE TEMP TABLE {STAGING_TABLE} (userid INTEGER, movieid INTEGER, rating REAL);")
+
+        moved = 0
+        if scheme in ('range', 'hash'):
+            # Step 2: Take out of every old partition the rows it no longer owns
+            for i, table_name in enumerate(old_tables):
+                if i >= numberofpartitions:
+                    # The partition disappears, all its rows move and the table is dropped below
+                    cur.execute(f"INSERT INTO {STAGING_TABLE} SELECT userid, movieid, rating FROM {table_name};")
+                    moved += cur.rowcount
+                    continue
+                if scheme == 'range':
+                    keep = _range_member_predicate(bounds, i)
+                else:
+                    keep = f"(({column} % {numberofpartitions}) + {numberofpartitions}) % {numberofpartitions} = {i}"
+                with phase('repartition.extract') as extract_phase:
+                    extract_phase.rows = _move_rows(cur, table_name, STAGING_TABLE, condition=f"NOT ({keep})")
+                moved += extract_phase.rows
+
+            # Step 3: Route the moved rows to their new partitions in one pass
+            if scheme == 'range':
+                source_query = f"""
+                    SELECT {_range_bucket_expression(bounds)} AS part, userid, movieid, rating
+                    FROM {STAGING_TABLE}
+                    WHERE rating >= {bounds[0]} AND rating <= {bounds[-1]}
+                """
+            else:
+                source_query = f"""
+                    SELECT (({column} % {numberofpartitions}) + {numberofpartitions}) % {numberofpartitions} AS part,
+                           userid, movieid, rating
+                    FROM {STAGING_TABLE}
+                """
+            with phase('repartition.route', rows=moved):
+                _fan_out_copy(cur, source_query, new_tables)
+        else:
+            # Step 2: Partition j of n has to hold ceil((total - j) / n) rows
+            counts = []
+            for table_name in old_tables:
+                cur.execute(f"SELECT COUNT(*) FROM {table_name};")
+                counts.append(cur.fetchone()[0])
+            total = sum(counts)
+            targets = [(total - j + numberofpartitions - 1) // numberofpartitions for j in range(numberofpartitions)]
+
+            # Step 3: Take the surplus out of partitions that are too big or disappear
+            for j, table_name in enumerate(old_tables):
+                target = targets[j] if j < numberofpartitions else 0
+                if counts[j] > target:
+                    with phase('repartition.extract', rows=counts[j] - target):
+                        moved += _move_rows(cur, table_name, STAGING_TABLE, limit=counts[j] - target)
+
+            # Step 4: Fill up the partitions that are short
+            for j, table_name in enumerate(new_tables):
+                current = counts[j] if j < len(old_tables) else 0
+                if current < targets[j]:
+                    with phase('repartition.route', rows=targets[j] - current):
+                        _move_rows(cur, STAGING_TABLE, table_name, limit=targets[j] - current)
+
+            cur.execute(f"UPDATE {RROBIN_META_TABLE} SET numberofpartitions = %s WHERE ratingstablename = %s;",
+                        (numberofpartitions, ratingstablename))
+
+        cur.execute(f"DROP TABLE {STAGING_TABLE};")
+
+        # Step 5: Record the new layout, dropping the partitions that are gone
+        _register_partitions(cur, prefix, ratingstablename, scheme, new_tables, bounds, column,
+                             boundaries if scheme == 'range' else None)
+        if indexes:
+            with phase('repartition.index'):
+                _index_partitions(cur, new_tables)
+                _refresh_zonemap(cur, prefix, new_tables)
+
+        with phase('repartition.commit'):
+            openconnection.commit()
+        invalidate_partition_cache(prefix)
+
+    except Exception as e:
+        openconnection.rollback()
+        print(f"Error repartitioning {prefix}: {str(e)}")
+        raise e
+
+    finally:
+        cur.close()
+
+    elapsed_time = time.perf_counter() - start_time
+    record('repartition', int(elapsed_time * 1e9), moved)
+    return dict(moved=moved, elapsed=elapsed_time)
+
+
+def _move_batch(cur, source_table, target_table, limit):
+    """
+    Move at most limit rows of source_table into target_table in one statement. Returns the
+    ZONEMAP_QUERY row (count and min/max of every column) of the moved rows.
+    """
+    cur.execute(f"""
+    WITH moved AS (
+        DELETE FROM {source_table} WHERE ctid IN (SELECT ctid FROM {source_table} LIMIT {int(limit)})
+        RETURNING userid, movieid, rating
+    ), inserted AS (
+        INSERT INTO {target_table} (userid, movieid, rating)
+        SELECT userid, movieid, rating FROM moved
+    )
+    {ZONEMAP_QUERY.format('moved')};
+    """)
+    return cur.fetchone()
+
+
+def _shift_zonemap(cur, source_table, target_table, zone):
+    """
+    Account in the stored zone maps for rows moved from source_table to target_table, zone being
+    their ZONEMAP_QUERY row. The source keeps its min/max, which may now be wider than needed.
+    """
+    cur.execute(f"UPDATE {PARTITION_ZONEMAP_TABLE} SET rowcount = rowcount - %s WHERE tablename = %s;",
+                (zone[0], source_table))
+    cur.execute(f"""
+    UPDATE {PARTITION_ZONEMAP_TABLE} SET rowcount = rowcount + %s,
+        minuserid = LEAST(minuserid, %s), maxuserid = GREATEST(maxuserid, %s),
+        minmovieid = LEAST(minmovieid, %s), maxmovieid = GREATEST(maxmovieid, %s),
+        minrating = LEAST(minrating, %s), maxrating = GREATEST(maxrating, %s)
+    WHERE tablename = %s;
+    """, (*zone, target_table))
+
+
+def _balance_moves(counts, targets):
+    """
+    (source, target, rows) moves that bring counts to targets, always pairing the partition with
+    the largest surplus with the one with the largest shortage.
+    """
+    surplus = sorted(((counts[i] - targets[i], i) for i in range(len(counts)) if counts[i] > targets[i]), reverse=True)
+    shortage = sorted(((targets[i] - counts[i], i) for i in range(len(counts)) if counts[i] < targets[i]), reverse=True)
+    moves = []
+    while surplus and shortage:
+        (extra, source), (missing, target) = surplus[0], shortage[0]
+        rows = min(extra, missing)
+        moves.append((source, target, rows))
+        surplus[0] = (extra - rows, source)
+        shortage[0] = (missing - rows, target)
+        if surplus[0][0] == 0:
+            surplus.pop(0)
+        if shortage[0][0] == 0:
+            shortage.pop(0)
+        surplus.sort(reverse=True)
+        shortage.sort(reverse=True)
+    return moves
+
+
+@timed('rebalanceroundrobin')
+def rebalanceroundrobin(openconnection, batchsize=10000, maxrows=None, dryrun=False):
+    """
+    Even out the sizes of the round robin partitions while they stay in use, e.g. after rows were
+    deleted from some of them.
+
+    The partitions are counted and every partition is given its round robin share of the total.
+    The partitions that get one row more are the ones right before the next insert position of
+    the row counter, so the following inserts fill the others first. Rows are then moved from the
+    largest partitions to the smallest ones in batches of at most batchsize rows, each committed
+    on its own so concurrent inserts and queries only ever wait for one batch. Before every batch
+    the source and target are counted again, so rows inserted or deleted meanwhile never make a
+    batch overshoot its target. The batches take turns between the moves, so the extra scanning
+    and deleting is spread over the partitions instead of draining one at a time.
 
+    The table statistics can lag seconds behind the partitions, so they are not used to plan the
+    moves; partitionbalance(prefix, openconnection, estimate=True) gives a cheap look at the skew.
+
+    Args:
+        openconnection: PostgreSQL connection object
+        batchsize (int): Maximum number of rows moved in one transaction
+        maxrows (int): Stop after moving this many rows (None moves everything planned)
+        dryrun (bool): Only report the sizes and the planned moves
+
+    Returns:
+        dict with the partition counts and skew as measured (see partitionbalance), the planned
+        moves as (source table, target table, rows) and the number of rows moved
+    """
+    RROBIN_TABLE_PREFIX = 'rrobin_part'
+    start_time = time.perf_counter()
+
+    info = get_partition_info(RROBIN_TABLE_PREFIX, openconnection)
+    if info['scheme'] != 'roundrobin':
+        raise ValueError(f"No registered round robin partitions with prefix {RROBIN_TABLE_PREFIX}")
+    if info['placement']:
+        raise ValueError(f"Partitions with prefix {RROBIN_TABLE_PREFIX} are placed on other nodes")
+    table_names = info['tablenames']
+
+    with phase('rebalanceroundrobin.measure'):
+        balance = partitionbalance(RROBIN_TABLE_PREFIX, openconnection)
+    counts = balance['counts']
+    numberofpartitions = len(counts)
+    total = sum(counts)
+
+    cur = openconnection.cursor()
+
+    try:
+        # The next insert goes to partition row_count % n
+        cur.execute(f"SELECT row_count FROM {RROBIN_META_TABLE} WHERE ratingstablename = %s;",
+                    (info['ratingstablename'],))
+        row = cur.fetchone()
+        next_row = row[0] if row is not None else total
         openconnection.commit()
-        print(f"Successfully inserted record into {ratingstablename} and {table_name}")
+
+        share, extra = divmod(total, numberofpartitions)
+        targets = [share + (1 if (i - next_row) % numberofpartitions >= numberofpartitions - extra else 0)
+                   for i in range(numberofpartitions)]
+        plan = _balance_moves(counts, targets)
+        if maxrows is not None:
+            budget, capped = maxrows, []
+            for source, target, rows in plan:
+                if budget <= 0:
+                    break
+                capped.append((source, target, min(rows, budget)))
+                budget -= rows
+            plan = capped
+
+        moved = 0
+        pending = [[source, target, rows] for source, target, rows in plan]
+        while pending and not dryrun:
+            for move in list(pending):
+                source_table, target_table = table_names[move[0]], table_names[move[1]]
+                with phase('rebalanceroundrobin.batch') as batch_phase:
+                    cur.execute(f"SELECT (SELECT COUNT(*) FROM {source_table}), "
+                                f"(SELECT COUNT(*) FROM {target_table});")
+                    source_count, target_count = cur.fetchone()
+                    size = min(batchsize, move[2], source_count - targets[move[0]],
+                               targets[move[1]] - target_count)
+                    if size <= 0:
+                        # Concurrent writes already evened this pair out
+                        openconnection.commit()
+                        pending.remove(move)
+                        continue
+                    zone = _move_batch(cur, source_table, target_table, size)
+                    if info['zonemap']:
+                        _shift_zonemap(cur, source_table, target_table, zone)
+                    openconnection.commit()
+                    batch_phase.rows = zone[0]
+                invalidate_partition_cache(RROBIN_TABLE_PREFIX)
+                moved += zone[0]
+                move[2] -= zone[0]
+                if move[2] <= 0 or zone[0] < size:
+                    pending.remove(move)
 
     except Exception as e:
-        # Rollback in case of error
         openconnection.rollback()
-        print(f"Error inserting record: {str(e)}")
+        print(f"Error rebalancing {RROBIN_TABLE_PREFIX}: {str(e)}")
         raise e
 
     finally:
-        # Close cursor (but not connection as per requirement)
         cur.close()
 
-    end_time = time.time()
-    total_time = end_time - start_time
-    print(f"rangeinsert completed in {total_time:.4f} seconds")
+    elapsed_time = time.perf_counter() - start_time
+    return dict(balance, moves=[(table_names[source], table_names[target], rows) for source, target, rows in plan],
+                moved=moved, elapsed=elapsed_time)
@@ -0,0 +1,112 @@
+"""
+Micro-batching ingest front end for the insert functions.
+
+Ratings are submitted one at a time from asyncio code, buffered until a batch is full or a short
+delay has passed, and written with rangeinsertbatch / roundrobininsertbatch in one transaction per
+batch. Each submit() returns once its row is committed, and rows land in the same partitions as
+with rangeinsert / roundrobininsert called in submission order.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from function import rangeinsertbatch, roundrobininsertbatch
+
+_BATCH_FUNCTIONS = {
+    'range': rangeinsertbatch,
+    'roundrobin': roundrobininsertbatch,
+}
+
+
+class IngestService:
+    """
+    Usage:
+        async with IngestService('ratings', conn, scheme='range') as service:
+            await service.submit(userid, movieid, rating)
+
+    The connection is used by a single worker thread only, so it must not be used elsewhere while
+    the service is running.
+    """
+
+    def __init__(self, ratingstablename, openconnection, scheme='range', maxbatch=1000, maxdelay=0.05):
+        if scheme not in _BATCH_FUNCTIONS:
+            raise ValueError(f"Unknown ingest scheme: {scheme}")
+        self.ratingstablename = ratingstablename
+        self.openconnection = openconnection
+        self.scheme = scheme
+        self.maxbatch = maxbatch
+        self.maxdelay = maxdelay
+        self._pending = []
+        self._timer = None
+        self._inflight = set()
+        # One worker thread: batches are committed in submission order, which round robin relies on
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def submit(self, userid, itemid, rating):
+        """
+        Queue one rating and wait until the batch containing it is committed.
+        """
+        if self._closed:
+            raise RuntimeError("IngestService is closed")
+        if self.scheme == 'range' and (rating > 5 or rating < 0):
+            raise ValueError(f"Rating value is invalid: {rating}")
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(((userid, itemid, rating), future))
+
+        if len(self._pending) >= self.maxbatch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.maxdelay, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.ensure_future(self._write(batch))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def _write(self, batch):
+        rows = [row for row, _ in batch]
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._executor, _BATCH_FUNCTIONS[self.scheme],
+                                       self.ratingstablename, rows, self.openconnection)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    async def flush(self):
+        """
+        Write everything submitted so far and wait for it to be committed.
+        """
+        self._flush()
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    async def close(self):
+        """
+        Flush the remaining rows and stop the worker thread. The connection is left open.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        await self.flush()
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,203 @@
+"""
+Timing instrumentation for the functions in function.py.
+
+Every function records its phases (parse, COPY, routing, per-partition INSERT, commit, ...) with
+`phase()` and its whole call with `@timed`. Measurements go to the active sink, which is a no-op
+by default so nothing is printed or stored unless a sink is installed:
+
+    from instrumentation import MemorySink, set_sink
+    sink = set_sink(MemorySink())
+    function.loadratings('ratings', path, conn)
+    print(sink.summary())
+"""
+import bisect
+import contextlib
+import functools
+import json
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket is unbounded
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+           300.0)
+
+
+class NullSink:
+    """
+    Discards every measurement.
+    """
+    enabled = False
+
+    def record(self, name, nanoseconds, rows=None):
+        pass
+
+
+class MemorySink:
+    """
+    Keeps per-phase call counts, total time, row counts and a latency histogram in memory.
+    """
+    enabled = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phases = {}
+
+    def record(self, name, nanoseconds, rows=None):
+        seconds = nanoseconds / 1e9
+        with self._lock:
+            stats = self.phases.get(name)
+            if stats is None:
+                stats = self.phases[name] = dict(count=0, seconds=0.0, rows=0, buckets=[0] * (len(BUCKETS) + 1))
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            if rows:
+                stats['rows'] += rows
+            stats['buckets'][bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def reset(self):
+        with self._lock:
+            self.phases = {}
+
+    def summary(self):
+        """
+        Per phase: calls, total and mean seconds, rows, rows/sec and the histogram bucket counts.
+        """
+        with self._lock:
+            result = {}
+            for name, stats in self.phases.items():
+                result[name] = dict(
+                    count=stats['count'],
+                    seconds=stats['seconds'],
+                    mean_seconds=stats['seconds'] / stats['count'],
+                    rows=stats['rows'],
+                    rows_per_sec=stats['rows'] / stats['seconds'] if stats['rows'] and stats['seconds'] else None,
+                    histogram=dict(zip([str(b) for b in BUCKETS] + ['+Inf'], stats['buckets'])),
+                )
+            return result
+
+
+class JsonLinesSink:
+    """
+    Appends one JSON object per measurement to a file.
+    """
+    enabled = True
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def record(self, name, nanoseconds, rows=None):
+        line = json.dumps(dict(phase=name, ns=nanoseconds, rows=rows, ts=time.time()))
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class PrometheusTextSink(MemorySink):
+    """
+    Aggregates like MemorySink and writes the result in the Prometheus text exposition format,
+    e.g. for the node exporter textfile collector. The file is rewritten on flush() and at most
+    every `interval` seconds while measurements come in.
+    """
+
+    def __init__(self, path, interval=10.0):
+        super().__init__()
+        self.path = path
+        self.interval = interval
+        self._written = 0.0
+
+    def record(self, name, nanoseconds, rows=None):
+        super().record(name, nanoseconds, rows)
+        if time.monotonic() - self._written >= self.interval:
+            self.flush()
+
+    def flush(self):
+        lines = [
+            '# HELP ratings_phase_duration_seconds Duration of the ratings partitioning phases.',
+            '# TYPE ratings_phase_duration_seconds histogram',
+        ]
+        rows = [
+            '# HELP ratings_phase_rows_total Rows processed by the ratings partitioning phases.',
+            '# TYPE ratings_phase_rows_total counter',
+        ]
+        with self._lock:
+            for name, stats in sorted(self.phases.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + (None,), stats['buckets']):
+                    cumulative += count
+                    le = '+Inf' if bound is None else repr(bound)
+                    lines.append(f'ratings_phase_duration_seconds_bucket{{phase="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'ratings_phase_duration_seconds_sum{{phase="{name}"}} {stats["seconds"]}')
+                lines.append(f'ratings_phase_duration_seconds_count{{phase="{name}"}} {stats["count"]}')
+                rows.append(f'ratings_phase_rows_total{{phase="{name}"}} {stats["rows"]}')
+            self._written = time.monotonic()
+        with open(self.path, 'w') as file:
+            file.write('\n'.join(lines + rows) + '\n')
+
+
+_sink = NullSink()
+
+
+def set_sink(sink):
+    """
+    Install the sink that receives every measurement (None restores the silent default) and return it.
+    """
+    global _sink
+    _sink = sink if sink is not None else NullSink()
+    return _sink
+
+
+def get_sink():
+    return _sink
+
+
+class _Phase:
+    __slots__ = ('rows',)
+
+    def __init__(self, rows):
+        self.rows = rows
+
+
+@contextlib.contextmanager
+def phase(name, rows=None):
+    """
+    Time the enclosed block as `name`. The row count can be given up front or set on the yielded
+    object (`with phase('copy') as p: ...; p.rows = n`). Failed blocks are not recorded.
+    """
+    sink = _sink
+    if not sink.enabled:
+        yield _Phase(rows)
+        return
+    current = _Phase(rows)
+    start = time.perf_counter_ns()
+    yield current
+    sink.record(name, time.perf_counter_ns() - start, current.rows)
+
+
+def timed(name):
+    """
+    Decorator recording the duration of every successful call of the function as `name`.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            sink = _sink
+            if not sink.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter_ns()
+            result = func(*args, **kwargs)
+            sink.record(name, time.perf_counter_ns() - start)
+            return result
+        return wrapper
+    return decorator
+
+
+def record(name, nanoseconds, rows=None):
+    """
+    Record a measurement taken elsewhere, e.g. time accumulated over many small steps.
+    """
+    if _sink.enabled:
+        _sink.record(name, nanoseconds, rows)
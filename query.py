@@ -0,0 +1,248 @@
+"""
+Partition-aware queries over the range_part, rrobin_part and hash_part tables.
+
+A query is described by a rating range and/or a userid/movieid. Partitions that cannot hold a
+matching row are pruned using the partition registry and the partition zone maps, the remaining
+partitions are queried at the same time over separate connections (to the node holding each
+partition when they are placed on several databases), and the results are merged here.
+"""
+import contextlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from function import get_partition_info, node_parameters, partition_connection_parameters, pooledconnection, read_zonemap
+from routing import as_real
+
+AGGREGATES = ('count', 'sum', 'avg', 'min', 'max')
+
+
+def _zone_may_match(zone, minrating, maxrating, userid, movieid):
+    """
+    False if the zone map of a partition rules out every row matching the predicate.
+    """
+    if zone['rowcount'] == 0:
+        return False
+    if minrating is not None:
+        minrating = as_real(minrating)
+    if maxrating is not None:
+        maxrating = as_real(maxrating)
+    for column, low, high in (('userid', userid, userid), ('movieid', movieid, movieid),
+                              ('rating', minrating, maxrating)):
+        if low is None and high is None:
+            continue
+        zonemin, zonemax = zone[column]
+        if zonemin is None:
+            # Only NULLs in this column, nothing can match a predicate on it
+            return False
+        if low is not None and low > zonemax:
+            return False
+        if high is not None and high < zonemin:
+            return False
+    return True
+
+
+def prunepartitions(prefix, openconnection, minrating=None, maxrating=None, userid=None, movieid=None):
+    """
+    Names of the partitions that may contain rows matching the predicate.
+    Range partitions are pruned on the rating bounds, hash partitions on their key, and partitions
+    with a zone map on the min/max of every column.
+    """
+    info = get_partition_info(prefix, openconnection)
+    table_names = list(info['tablenames'])
+
+    if info['scheme'] in ('range', 'range_native') and info['boundaries']:
+        bounds = info['boundaries']
+        kept = []
+        for i, table_name in enumerate(table_names):
+            # Partition i holds bounds[i] < rating <= bounds[i + 1], partition 0 also bounds[0]
+            if minrating is not None and minrating > bounds[i + 1]:
+                continue
+            if maxrating is not None and (maxrating < bounds[i] or (i > 0 and maxrating == bounds[i])):
+                continue
+            kept.append(table_name)
+        table_names = kept
+
+    if info['scheme'] == 'hash':
+        key = userid if info['partitionkey'] == 'userid' else movieid
+        if key is not None:
+            table_names = [table_names[key % info['numberofpartitions']]]
+
+    # Other connections and routing triggers only widen the stored zone maps, read them for every query
+    zonemap = read_zonemap(prefix, openconnection) if table_names else None
+    if zonemap:
+        table_names = [table_name for table_name in table_names
+                       if table_name not in zonemap
+                       or _zone_may_match(zonemap[table_name], minrating, maxrating, userid, movieid)]
+
+    return table_names
+
+
+def _where_clause(minrating, maxrating, userid, movieid):
+    conditions, params = [], []
+    if minrating is not None:
+        conditions.append("rating >= %s")
+        params.append(minrating)
+    if maxrating is not None:
+        conditions.append("rating <= %s")
+        params.append(maxrating)
+    if userid is not None:
+        conditions.append("userid = %s")
+        params.append(userid)
+    if movieid is not None:
+        conditions.append("movieid = %s")
+        params.append(movieid)
+    if not conditions:
+        return "", params
+    return " WHERE " + " AND ".join(conditions), params
+
+
+def partitionlookup(prefix, openconnection, minrating=None, maxrating=None, userid=None, movieid=None):
+    """
+    All (userid, movieid, rating) rows matching the predicate, read with one query per database
+    over the partitions left after pruning. Meant for selective lookups such as a single userid or
+    movieid, which the partition indexes answer without scanning.
+    """
+    table_names = prunepartitions(prefix, openconnection, minrating, maxrating, userid, movieid)
+    where, params = _where_clause(minrating, maxrating, userid, movieid)
+
+    # Partitions in the coordinator database are read on the given connection, the others on their node
+    placement = get_partition_info(prefix, openconnection)['placement'] or {}
+    by_node = {}
+    for table_name in table_names:
+        by_node.setdefault(placement.get(table_name), []).append(table_name)
+
+    rows = []
+    for node, node_tables in by_node.items():
+        query = ' UNION ALL '.join(f"SELECT userid, movieid, rating FROM {table_name}{where}"
+                                   for table_name in node_tables)
+        with contextlib.ExitStack() as stack:
+            con = openconnection if node is None else stack.enter_context(pooledconnection(**node_parameters(node)))
+            cur = con.cursor()
+            try:
+                cur.execute(query + ";", params * len(node_tables))
+                rows.extend(cur.fetchall())
+            finally:
+                cur.close()
+    return rows
+
+
+def _put(batches, item, stop):
+    # Give up once the consumer has stopped, so no worker stays blocked on a full queue
+    while not stop.is_set():
+        try:
+            batches.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def _stream_partition(connection_params, table_name, where, params, batches, stop, batchsize):
+    with pooledconnection(**connection_params) as con:
+        # A named cursor keeps the partition on the server and hands it over batchsize rows at a time
+        cur = con.cursor(name=f"scan_{table_name}")
+        cur.execute(f"SELECT userid, movieid, rating FROM {table_name}{where};", params)
+        while not stop.is_set():
+            rows = cur.fetchmany(batchsize)
+            if not rows:
+                break
+            _put(batches, rows, stop)
+        cur.close()
+
+
+def parallelselect(prefix, openconnection, minrating=None, maxrating=None, userid=None, movieid=None,
+                   workers=4, batchsize=10000):
+    """
+    Generator over the (userid, movieid, rating) rows matching the predicate. Every partition left
+    after pruning is scanned by its own worker; rows are yielded in batches as soon as any
+    partition delivers them, so the result is never materialized as a whole.
+    """
+    table_names = prunepartitions(prefix, openconnection, minrating, maxrating, userid, movieid)
+    if not table_names:
+        return
+    where, params = _where_clause(minrating, maxrating, userid, movieid)
+    info = get_partition_info(prefix, openconnection)
+    connection_params = {table_name: partition_connection_parameters(info, table_name, openconnection)
+                         for table_name in table_names}
+
+    batches = queue.Queue(maxsize=workers * 2)
+    stop = threading.Event()
+    done = object()
+
+    def scan(table_name):
+        if stop.is_set():
+            return
+        try:
+            _stream_partition(connection_params[table_name], table_name, where, params, batches, stop, batchsize)
+        except Exception as e:
+            _put(batches, e, stop)
+            return
+        _put(batches, done, stop)
+
+    pool = ThreadPoolExecutor(max_workers=min(workers, len(table_names)))
+    try:
+        for table_name in table_names:
+            pool.submit(scan, table_name)
+        remaining = len(table_names)
+        while remaining:
+            item = batches.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield from item
+    finally:
+        # Scans not started yet are dropped, running ones give up their next put within 0.1s
+        stop.set()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _partial_aggregate(connection_params, table_name, where, params):
+    with pooledconnection(**connection_params) as con:
+        cur = con.cursor()
+        cur.execute(f"""
+        SELECT COUNT(*), COUNT(rating), SUM(rating::DOUBLE PRECISION), MIN(rating), MAX(rating)
+        FROM {table_name}{where};
+        """, params)
+        row = cur.fetchone()
+        cur.close()
+        return row
+
+
+def parallelaggregate(prefix, openconnection, aggregate, minrating=None, maxrating=None, userid=None,
+                      movieid=None, workers=4):
+    """
+    count, sum, avg, min or max of the ratings matching the predicate, computed per partition in
+    parallel and combined from the partial results.
+    """
+    if aggregate not in AGGREGATES:
+        raise ValueError(f"Unknown aggregate: {aggregate}")
+
+    table_names = prunepartitions(prefix, openconnection, minrating, maxrating, userid, movieid)
+    where, params = _where_clause(minrating, maxrating, userid, movieid)
+    info = get_partition_info(prefix, openconnection)
+    connection_params = {table_name: partition_connection_parameters(info, table_name, openconnection)
+                         for table_name in table_names}
+
+    partials = []
+    if table_names:
+        with ThreadPoolExecutor(max_workers=min(workers, len(table_names))) as pool:
+            partials = list(pool.map(lambda table_name: _partial_aggregate(connection_params[table_name], table_name,
+                                                                           where, params), table_names))
+
+    rows = sum(p[0] for p in partials)
+    ratings = sum(p[1] for p in partials)
+    total = sum(p[2] for p in partials if p[2] is not None)
+    minimums = [p[3] for p in partials if p[3] is not None]
+    maximums = [p[4] for p in partials if p[4] is not None]
+
+    if aggregate == 'count':
+        return rows
+    if aggregate == 'sum':
+        return total if ratings else None
+    if aggregate == 'avg':
+        return total / ratings if ratings else None
+    if aggregate == 'min':
+        return min(minimums) if minimums else None
+    return max(maximums) if maximums else None
@@ -0,0 +1,90 @@
+"""
+Partition routing for whole batches of rows, used by the bulk insert and load paths.
+
+A batch is routed column-wise: the ratings (or the row ordinals for round robin) of every row
+are turned into partition indexes at once, then the rows are grouped per partition and written
+out as COPY text. NumPy is used when it is installed; without it the same functions fall back to
+plain Python and give the same result.
+
+Range routing follows the partition boundaries exactly as the server applies them: partition i
+holds bounds[i] < rating <= bounds[i + 1] (partition 0 also bounds[0]), where rating is the REAL
+value the column stores. A rating is therefore rounded to single precision before it is compared
+with the double precision boundaries, so a value that only crosses a boundary once it is stored
+is routed where the server puts it.
+"""
+import bisect
+import io
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Batches smaller than this are routed in plain Python, converting them to arrays costs more
+VECTORIZE_MIN_ROWS = 64
+
+
+def as_real(value):
+    """
+    The value a REAL column stores for value.
+    """
+    return struct.unpack('f', struct.pack('f', value))[0]
+
+
+def range_partition_id(rating, bounds):
+    """
+    Index of the range partition holding rating, the first partition whose upper bound is not
+    below the stored rating.
+    """
+    return bisect.bisect_left(bounds, as_real(rating), 1, len(bounds) - 1) - 1
+
+
+def range_partition_ids(ratings, bounds):
+    """
+    Range partition index of every rating, as a list (or a NumPy array when NumPy is installed
+    and the batch is large enough).
+    """
+    if np is None or len(ratings) < VECTORIZE_MIN_ROWS:
+        return [range_partition_id(rating, bounds) for rating in ratings]
+    stored = np.asarray(ratings, dtype=np.float32).astype(np.float64)
+    # Searching the inner boundaries from the left puts a rating equal to a bound in the lower partition
+    return np.searchsorted(np.asarray(bounds[1:-1], dtype=np.float64), stored, side='left')
+
+
+def roundrobin_partition_ids(first_row, count, numberofpartitions):
+    """
+    Round robin partition index of count rows numbered first_row, first_row + 1, ... (row
+    numbers start at 1, row r goes to partition (r - 1) % numberofpartitions).
+    """
+    if np is None or count < VECTORIZE_MIN_ROWS:
+        return [(first_row + j - 1) % numberofpartitions for j in range(count)]
+    return np.arange(first_row - 1, first_row - 1 + count, dtype=np.int64) % numberofpartitions
+
+
+def group_rows(rows, ids):
+    """
+    Group rows by partition index as {index: [rows in their original order]}.
+    """
+    if np is None or not isinstance(ids, np.ndarray):
+        groups = {}
+        for row, index in zip(rows, ids):
+            groups.setdefault(index, []).append(row)
+        return groups
+    order = np.argsort(ids, kind='stable')
+    sorted_ids = ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    ends = np.r_[starts[1:], len(order)]
+    return {int(sorted_ids[start]): [rows[k] for k in order[start:end]] for start, end in zip(starts, ends)}
+
+
+def _copy_value(value):
+    return '\\N' if value is None else str(value)
+
+
+def copy_buffer(rows):
+    """
+    File-like object with the (userid, movieid, rating) rows in COPY text format.
+    """
+    return io.StringIO(''.join(f"{_copy_value(userid)}\t{_copy_value(movieid)}\t{_copy_value(rating)}\n"
+                               for userid, movieid, rating in rows))
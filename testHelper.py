@@ -3,6 +3,8 @@ import psycopg2
 
 RANGE_TABLE_PREFIX = 'range_part'
 RROBIN_TABLE_PREFIX = 'rrobin_part'
+HASH_TABLE_PREFIX = 'hash_part'
+PARTITION_REGISTRY_TABLE = 'partition_registry'
 USER_ID_COLNAME = 'userid'
 MOVIE_ID_COLNAME = 'movieid'
 RATING_COLNAME = 'rating'
@@ -57,27 +59,29 @@ def getopenconnection(user='postgres', password='root', dbname='db_assign1'):
 
 
 ####### Tester support
-def getCountrangepartition(ratingstablename, numberofpartitions, openconnection):
+def getCountrangepartition(ratingstablename, numberofpartitions, openconnection, boundaries=None):
     """
     Get number of rows for each partition
     :param ratingstablename:
     :param numberofpartitions:
     :param openconnection:
+    :param boundaries: Partition boundaries (numberofpartitions + 1 values), equal-width ones by default
     :return:
     """
     cur = openconnection.cursor()
-    countList = []
-    interval = 5.0 / numberofpartitions
-    cur.execute("select count(*) from {0} where rating >= {1} and rating <= {2}".format(ratingstablename,0, interval))
-    countList.append(int(cur.fetchone()[0]))
+    if boundaries is None:
+        interval = 5.0 / numberofpartitions
+        boundaries = [i * interval for i in range(numberofpartitions + 1)]
 
-    lowerbound = interval
+    # Bucket every row in a single grouped pass, with the same bounds as one count per range
+    cases = ["when rating >= {0} and rating <= {1} then 0".format(boundaries[0], boundaries[1])]
     for i in range(1, numberofpartitions):
-        cur.execute("select count(*) from {0} where rating > {1} and rating <= {2}".format(ratingstablename,
-                                                                                          lowerbound,
-                                                                                          lowerbound + interval))
-        lowerbound += interval
-        countList.append(int(cur.fetchone()[0]))
+        cases.append("when rating > {0} and rating <= {1} then {2}".format(boundaries[i], boundaries[i + 1], i))
+    cur.execute("select part, count(*) from (select case {0} end as part from {1}) as temp "
+                "where part is not null group by part".format(' '.join(cases), ratingstablename))
+    countList = [0] * numberofpartitions
+    for part, count in cur.fetchall():
+        countList[part] = int(count)
 
     cur.close()
     return countList
@@ -92,16 +96,37 @@ def getCountroundrobinpartition(ratingstablename, numberofpartitions, openconnec
     :return:
     '''
     cur = openconnection.cursor()
-    countList = []
-    for i in range(0, numberofpartitions):
-        cur.execute(
-            "select count(*) from (select *, row_number() over () from {0}) as temp where (row_number-1)%{1}= {2}".format(
-                ratingstablename, numberofpartitions, i))
-        countList.append(int(cur.fetchone()[0]))
+    cur.execute("select count(*) from {0}".format(ratingstablename))
+    total = int(cur.fetchone()[0])
+
+    # Row number r goes to partition (r-1) % n, so partition i holds every n-th row starting at i+1
+    countList = [(total - i + numberofpartitions - 1) // numberofpartitions for i in range(0, numberofpartitions)]
+
+    cur.close()
+    return countList
+
+def getCounthashpartition(ratingstablename, numberofpartitions, openconnection, column=USER_ID_COLNAME):
+    """
+    Get number of rows for each hash partition, the row going to ((column % n) + n) % n
+    :return: list of counts in partition order
+    """
+    cur = openconnection.cursor()
+    cur.execute("select (({0} % {1}) + {1}) % {1} as part, count(*) from {2} group by part".format(
+        column, numberofpartitions, ratingstablename))
+    countList = [0] * numberofpartitions
+    for part, count in cur.fetchall():
+        countList[part] = int(count)
 
     cur.close()
     return countList
 
+
+def getregisteredboundaries(prefix, openconnection):
+    with openconnection.cursor() as cur:
+        cur.execute("SELECT boundaries FROM {0} WHERE prefix = %s".format(PARTITION_REGISTRY_TABLE), (prefix,))
+        row = cur.fetchone()
+        return row[0] if row is not None else None
+
 # Helpers for Tester functions
 def checkpartitioncount(cursor, expectedpartitions, prefix):
     cursor.execute(
@@ -123,32 +148,84 @@ def totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartin
     return count
 
 
-def testrangeandrobinpartitioning(n, openconnection, rangepartitiontableprefix, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE):
+# Order-independent fingerprint of a row: summed over a table it changes when any row is missing,
+# duplicated or altered, whatever the physical order of the rows
+ROW_HASH = "hashtextextended({0}::text || ':' || {1}::text || ':' || {2}::text, 0)::numeric".format(
+    USER_ID_COLNAME, MOVIE_ID_COLNAME, RATING_COLNAME)
+
+
+def tablechecksum(cur, tablename):
+    """
+    Row count and checksum of a table in one scan
+    :return: (count, checksum)
+    """
+    cur.execute('SELECT COUNT(*), COALESCE(SUM({0}), 0) FROM {1}'.format(ROW_HASH, tablename))
+    count, checksum = cur.fetchone()
+    return int(count), checksum
+
+
+def partitionchecksums(cur, n, rangepartitiontableprefix, partitionstartindex):
+    """
+    Row count of every partition and the checksum of all of them together, in a single pass
+    over the partitions
+    :return: (list of counts in partition order, total checksum)
+    """
+    selects = []
+    for i in range(partitionstartindex, n + partitionstartindex):
+        selects.append('SELECT {0} AS part, {1} AS h FROM {2}{0}'.format(i, ROW_HASH, rangepartitiontableprefix))
+    cur.execute('SELECT part, COUNT(*), COALESCE(SUM(h), 0) FROM ({0}) AS T GROUP BY part'.format(
+        ' UNION ALL '.join(selects)))
+    counts = [0] * n
+    checksum = 0
+    for part, count, partchecksum in cur.fetchall():
+        counts[part - partitionstartindex] = int(count)
+        checksum += partchecksum
+    return counts, checksum
+
+
+def testrangeandrobinpartitioning(n, openconnection, rangepartitiontableprefix, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE,
+                                  ratingstablename=None):
+    """
+    Checks the partitions for Completeness, Disjointness and Reconstruction. All partitions are read
+    once; with ratingstablename the merged partitions must also hold exactly the rows of that table.
+    :return: list with the number of rows of each partition (None if 'n' is invalid)
+    """
     with openconnection.cursor() as cur:
         if not isinstance(n, int) or n < 0:
             # Test 1: Check the number of tables created, if 'n' is invalid
             checkpartitioncount(cur, 0, rangepartitiontableprefix)
-        else:
-            # Test 2: Check the number of tables created, if all args are correct
-            checkpartitioncount(cur, n, rangepartitiontableprefix)
+            return None
 
-            # Test 3: Test Completeness by SQL UNION ALL Magic
-            count = totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex)
-            if count < ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
-                "Completeness property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
-                    ACTUAL_ROWS_IN_INPUT_FILE, count))
+        # Test 2: Check the number of tables created, if all args are correct
+        checkpartitioncount(cur, n, rangepartitiontableprefix)
 
-            # Test 4: Test Disjointness by SQL UNION Magic
-            count = totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex)
-            if count > ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
-                "Dijointness property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
-                    ACTUAL_ROWS_IN_INPUT_FILE, count))
+        # Count and checksum every partition once, the tests below all use this result
+        counts, checksum = partitionchecksums(cur, n, rangepartitiontableprefix, partitionstartindex)
+        count = sum(counts)
 
-            # Test 5: Test Reconstruction by SQL UNION Magic
-            count = totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex)
-            if count != ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
-                "Rescontruction property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
-                    ACTUAL_ROWS_IN_INPUT_FILE, count))
+        # Test 3: Test Completeness by SQL UNION ALL Magic
+        if count < ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
+            "Completeness property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
+                ACTUAL_ROWS_IN_INPUT_FILE, count))
+
+        # Test 4: Test Disjointness by SQL UNION Magic
+        if count > ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
+            "Dijointness property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
+                ACTUAL_ROWS_IN_INPUT_FILE, count))
+
+        # Test 5: Test Reconstruction by SQL UNION Magic
+        if count != ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
+            "Rescontruction property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
+                ACTUAL_ROWS_IN_INPUT_FILE, count))
+
+        # Test 6: Test Reconstruction by checksum, the merged partitions hold the same rows as the table
+        if ratingstablename is not None:
+            expectedcount, expectedchecksum = tablechecksum(cur, ratingstablename)
+            if count != expectedcount or checksum != expectedchecksum: raise Exception(
+                "Rescontruction property of Partitioning failed. Merged tables do not hold the same rows as {0} "
+                "(checksum {1} != {2})".format(ratingstablename, checksum, expectedchecksum))
+
+        return counts
 
 
 def testrangerobininsert(expectedtablename, itemid, openconnection, rating, userid):
@@ -163,23 +240,29 @@ def testrangerobininsert(expectedtablename, itemid, openconnection, rating, user
         if count != 1:  return False
         return True
 
-def testEachRangePartition(ratingstablename, n, openconnection, rangepartitiontableprefix):
+def testEachRangePartition(ratingstablename, n, openconnection, rangepartitiontableprefix, partitioncounts=None):
     countList = getCountrangepartition(ratingstablename, n, openconnection)
     cur = openconnection.cursor()
     for i in range(0, n):
-        cur.execute("select count(*) from {0}{1}".format(rangepartitiontableprefix, i))
-        count = int(cur.fetchone()[0])
+        if partitioncounts is not None:
+            count = partitioncounts[i]
+        else:
+            cur.execute("select count(*) from {0}{1}".format(rangepartitiontableprefix, i))
+            count = int(cur.fetchone()[0])
         if count != countList[i]:
             raise Exception("{0}{1} has {2} of rows while the correct number should be {3}".format(
                 rangepartitiontableprefix, i, count, countList[i]
             ))
 
-def testEachRoundrobinPartition(ratingstablename, n, openconnection, roundrobinpartitiontableprefix):
+def testEachRoundrobinPartition(ratingstablename, n, openconnection, roundrobinpartitiontableprefix, partitioncounts=None):
     countList = getCountroundrobinpartition(ratingstablename, n, openconnection)
     cur = openconnection.cursor()
     for i in range(0, n):
-        cur.execute("select count(*) from {0}{1}".format(roundrobinpartitiontableprefix, i))
-        count = cur.fetchone()[0]
+        if partitioncounts is not None:
+            count = partitioncounts[i]
+        else:
+            cur.execute("select count(*) from {0}{1}".format(roundrobinpartitiontableprefix, i))
+            count = cur.fetchone()[0]
         if count != countList[i]:
             raise Exception("{0}{1} has {2} of rows while the correct number should be {3}".format(
                 roundrobinpartitiontableprefix, i, count, countList[i]
@@ -223,8 +306,10 @@ def testrangepartition(MyAssignment, ratingstablename, n, openconnection, partit
 
     try:
         MyAssignment.rangepartition(ratingstablename, n, openconnection)
-        testrangeandrobinpartitioning(n, openconnection, RANGE_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE)
-        testEachRangePartition(ratingstablename, n, openconnection, RANGE_TABLE_PREFIX)
+        counts = testrangeandrobinpartitioning(n, openconnection, RANGE_TABLE_PREFIX, partitionstartindex,
+                                               ACTUAL_ROWS_IN_INPUT_FILE, ratingstablename)
+        testEachRangePartition(ratingstablename, n, openconnection, RANGE_TABLE_PREFIX,
+                               counts if partitionstartindex == 0 else None)
         return [True, None]
     except Exception as e:
         traceback.print_exc()
@@ -243,8 +328,10 @@ def testroundrobinpartition(MyAssignment, ratingstablename, numberofpartitions,
     """
     try:
         MyAssignment.roundrobinpartition(ratingstablename, numberofpartitions, openconnection)
-        testrangeandrobinpartitioning(numberofpartitions, openconnection, RROBIN_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE)
-        testEachRoundrobinPartition(ratingstablename, numberofpartitions, openconnection, RROBIN_TABLE_PREFIX)
+        counts = testrangeandrobinpartitioning(numberofpartitions, openconnection, RROBIN_TABLE_PREFIX, partitionstartindex,
+                                               ACTUAL_ROWS_IN_INPUT_FILE, ratingstablename)
+        testEachRoundrobinPartition(ratingstablename, numberofpartitions, openconnection, RROBIN_TABLE_PREFIX,
+                                    counts if partitionstartindex == 0 else None)
     except Exception as e:
         traceback.print_exc()
         return [False, e]
@@ -295,4 +382,113 @@ def testrangeinsert(MyAssignment, ratingstablename, userid, itemid, rating, open
     except Exception as e:
         traceback.print_exc()
         return [False, e]
-    return [True, None]
\ No newline at end of file
+    return [True, None]
+
+
+def checkpartitioncounts(prefix, counts, expectedcounts):
+    for i, (count, expected) in enumerate(zip(counts, expectedcounts)):
+        if count != expected:
+            raise Exception("{0}{1} has {2} of rows while the correct number should be {3}".format(
+                prefix, i, count, expected))
+
+
+def testhashpartition(MyAssignment, ratingstablename, n, openconnection, ACTUAL_ROWS_IN_INPUT_FILE,
+                      column=USER_ID_COLNAME):
+    """
+    Tests the hash partition function for Completness, Disjointness and Reconstruction, and that every
+    partition holds exactly the rows whose key hashes to it
+    :return:Raises exception if any test fails
+    """
+    try:
+        MyAssignment.hashpartition(ratingstablename, n, openconnection, column=column)
+        counts = testrangeandrobinpartitioning(n, openconnection, HASH_TABLE_PREFIX, 0,
+                                               ACTUAL_ROWS_IN_INPUT_FILE, ratingstablename)
+        checkpartitioncounts(HASH_TABLE_PREFIX, counts,
+                             getCounthashpartition(ratingstablename, n, openconnection, column))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testrepartition(MyAssignment, ratingstablename, n, openconnection, prefix, ACTUAL_ROWS_IN_INPUT_FILE, column=None):
+    """
+    Tests repartition on an existing partitioning: afterwards there are n partitions holding exactly
+    the rows of the ratings table, each partition the rows its scheme assigns to it
+    :param prefix: RANGE_TABLE_PREFIX, RROBIN_TABLE_PREFIX or HASH_TABLE_PREFIX
+    :param column: Hash partitioning key, for HASH_TABLE_PREFIX
+    :return:Raises exception if any test fails
+    """
+    try:
+        MyAssignment.repartition(ratingstablename, n, openconnection, prefix=prefix)
+        counts = testrangeandrobinpartitioning(n, openconnection, prefix, 0, ACTUAL_ROWS_IN_INPUT_FILE,
+                                               ratingstablename)
+        if prefix == RANGE_TABLE_PREFIX:
+            expectedcounts = getCountrangepartition(ratingstablename, n, openconnection,
+                                                    getregisteredboundaries(prefix, openconnection))
+        elif prefix == HASH_TABLE_PREFIX:
+            expectedcounts = getCounthashpartition(ratingstablename, n, openconnection, column or USER_ID_COLNAME)
+        else:
+            # Round robin partitions keep their rows, only the sizes have to be the round robin ones
+            expectedcounts = getCountroundrobinpartition(ratingstablename, n, openconnection)
+        checkpartitioncounts(prefix, counts, expectedcounts)
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testrebalanceroundrobin(MyAssignment, n, openconnection):
+    """
+    Tests the round robin rebalancer: the partitions hold the same rows before and after, and their
+    sizes differ by at most one row
+    :return:Raises exception if any test fails
+    """
+    try:
+        with openconnection.cursor() as cur:
+            beforecounts, beforechecksum = partitionchecksums(cur, n, RROBIN_TABLE_PREFIX, 0)
+        openconnection.commit()
+        MyAssignment.rebalanceroundrobin(openconnection)
+        with openconnection.cursor() as cur:
+            counts, checksum = partitionchecksums(cur, n, RROBIN_TABLE_PREFIX, 0)
+        if sum(counts) != sum(beforecounts) or checksum != beforechecksum:
+            raise Exception("Rebalancing changed the rows of the round robin partitions ({0} rows before, {1} after)".format(
+                sum(beforecounts), sum(counts)))
+        if max(counts) - min(counts) > 1:
+            raise Exception("Round robin partitions are not balanced after rebalancing: {0}".format(counts))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testroutingtrigger(MyAssignment, ratingstablename, prefix, n, userid, itemid, rating, openconnection,
+                       expectedtableindex):
+    """
+    Tests server-side routing: with the routing trigger of prefix installed, a plain INSERT into the
+    ratings table has to land in the expected partition, and the partitions still hold exactly the
+    rows of the ratings table. The trigger is dropped again at the end
+    :param prefix: RANGE_TABLE_PREFIX or RROBIN_TABLE_PREFIX
+    :return:Raises exception if any test fails
+    """
+    try:
+        MyAssignment.installroutingtrigger(prefix, openconnection)
+        try:
+            with openconnection.cursor() as cur:
+                cur.execute("INSERT INTO {0} ({1}, {2}, {3}) VALUES (%s, %s, %s)".format(
+                    ratingstablename, USER_ID_COLNAME, MOVIE_ID_COLNAME, RATING_COLNAME), (userid, itemid, rating))
+            openconnection.commit()
+            expectedtablename = prefix + expectedtableindex
+            if not testrangerobininsert(expectedtablename, itemid, openconnection, rating, userid):
+                raise Exception('Routing trigger failed! Couldnt find ({0}, {1}, {2}) tuple in {3} table'.format(
+                    userid, itemid, rating, expectedtablename))
+            with openconnection.cursor() as cur:
+                count, _ = tablechecksum(cur, ratingstablename)
+            testrangeandrobinpartitioning(n, openconnection, prefix, 0, count, ratingstablename)
+        finally:
+            MyAssignment.droproutingtrigger(prefix, openconnection)
+    except Exception as e:
+        openconnection.rollback()
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]